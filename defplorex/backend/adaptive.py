@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+from __future__ import division
+
+# built-in modules
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveBulkSizer(object):
+    """
+    Size bulk chunks (in docs and in bytes) by cluster feedback.
+
+    After every bulk request, `record()` is fed with its latency and the
+    number of rejected items (429, `es_rejected_execution_exception`):
+
+      * rejections halve the chunk and double the backoff delay;
+      * latency above `target_latency` shrinks the chunk by `shrink`;
+      * a healthy request (no rejections, latency below half of the
+        target) grows the chunk by `grow`;
+      * a request without rejections halves the backoff, down to zero
+        once below `initial_backoff`.
+
+    Senders are expected to wait `backoff` seconds before each request.
+    The backoff is shared by all sender threads, as rejections come from
+    the cluster as a whole; decaying it, rather than resetting it on the
+    first success, keeps one lucky sender from lifting the backoff of the
+    others while the cluster is still rejecting.
+
+    With `enabled` false, the sizes stay fixed and only stats are kept.
+    """
+    def __init__(self, chunk_size=1000, chunk_bytes=10 * 1024 * 1024,
+                 enabled=True, min_chunk_size=50, max_chunk_size=5000,
+                 min_chunk_bytes=1024 * 1024,
+                 max_chunk_bytes=100 * 1024 * 1024,
+                 target_latency=2.0, grow=1.25, shrink=0.75,
+                 initial_backoff=1.0, max_backoff=60.0, max_retries=3):
+        self.enabled = enabled
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.min_chunk_bytes = min_chunk_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        self.target_latency = target_latency
+        self.grow = grow
+        self.shrink = shrink
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+
+        self.chunk_size = int(chunk_size)
+        self.chunk_bytes = int(chunk_bytes)
+        self.backoff = 0
+
+        self._lock = threading.Lock()
+
+        self.stats = dict(
+                requests=0,
+                rejected=0,
+                docs=0,
+                bytes=0,
+                last_latency=None)
+
+    @classmethod
+    def from_settings(cls, settings):
+        kwargs = dict(settings.get('bulk', {}).get('adaptive', {}))
+        kwargs.setdefault('chunk_size', settings.get('bulk_size', 1000))
+        return cls(**kwargs)
+
+    def _resize(self, factor):
+        self.chunk_size = int(min(
+            self.max_chunk_size,
+            max(self.min_chunk_size, self.chunk_size * factor)))
+        self.chunk_bytes = int(min(
+            self.max_chunk_bytes,
+            max(self.min_chunk_bytes, self.chunk_bytes * factor)))
+
+    def record(self, latency, n_docs, n_bytes, rejected=0):
+        """Account for one bulk request and adapt the sizes"""
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['rejected'] += rejected
+            self.stats['docs'] += n_docs
+            self.stats['bytes'] += n_bytes
+            self.stats['last_latency'] = latency
+
+            if not self.enabled:
+                return
+
+            before = self.chunk_size, self.chunk_bytes
+
+            if rejected:
+                self._resize(0.5)
+                self.backoff = min(
+                        self.max_backoff,
+                        max(self.initial_backoff, self.backoff * 2))
+            else:
+                self.backoff /= 2
+                if self.backoff < self.initial_backoff:
+                    self.backoff = 0
+
+                if latency > self.target_latency:
+                    self._resize(self.shrink)
+                elif latency < self.target_latency / 2:
+                    self._resize(self.grow)
+
+            if (self.chunk_size, self.chunk_bytes) != before:
+                log.info(
+                        'Bulk chunk resized: %d -> %d docs, %d -> %d bytes'
+                        ' (latency = %.2fs, rejected = %d, backoff = %.1fs)',
+                        before[0], self.chunk_size,
+                        before[1], self.chunk_bytes,
+                        latency, rejected, self.backoff)
+
+    def snapshot(self):
+        """Current sizes and counters, e.g., for logs and monitoring"""
+        with self._lock:
+            snap = dict(self.stats)
+            snap.update(**dict(
+                chunk_size=self.chunk_size,
+                chunk_bytes=self.chunk_bytes,
+                backoff=self.backoff))
+            return snap
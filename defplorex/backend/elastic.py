@@ -32,17 +32,43 @@ from __future__ import division
 
 # built-in modules
 import gc
+import time
 import logging
+import threading
 from datetime import datetime
 
 # 3rd party modules
 import simplejson
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch, TransportError, helpers
 from elasticsearch_dsl import Search, Q
 
+# local modules
+from defplorex.backend.adaptive import AdaptiveBulkSizer
+from defplorex.backend.encoder import encode_op
+from defplorex.backend.staged import StagedPipeline
+
 log = logging.getLogger(__name__)
 
 
+# bulk item statuses worth retrying: the cluster is overloaded, not the doc
+TRANSIENT_STATUSES = (429, 502, 503, 504)
+
+# failure status of docs that could not be transformed
+TRANSFORM_ERROR = 'transform'
+
+_MISSING = object()
+
+
+def is_transient(status):
+    """
+    Whether a failure with this status may succeed on retry: transform
+    errors, connection errors (no HTTP status) and overload responses
+    """
+    if status == TRANSFORM_ERROR or not isinstance(status, int):
+        return True
+    return status in TRANSIENT_STATUSES
+
+
 class FailedTransformException(Exception):
     def __init__(self, message, _id):
         super(FailedTransformException, self).__init__(message)
@@ -50,6 +76,26 @@ class FailedTransformException(Exception):
         self._id = _id
 
 
+class FailedDocsException(Exception):
+    """
+    Some documents of a batch have failed; `failures` maps their IDs to the
+    failure status (HTTP status of the bulk item, or `TRANSFORM_ERROR`)
+    """
+    def __init__(self, failures):
+        super(FailedDocsException, self).__init__(
+                '{} docs have failed'.format(len(failures)))
+
+        self.failures = failures
+
+    @property
+    def transient_ids(self):
+        return [k for k, v in self.failures.items() if is_transient(v)]
+
+    @property
+    def permanent_ids(self):
+        return [k for k, v in self.failures.items() if not is_transient(v)]
+
+
 class ESStorer(object):
     """
     Generic ES wrapper
@@ -69,8 +115,18 @@ class ESStorer(object):
         self.id_field = settings.get('id_field')
         self.bulk_size = settings.get('bulk_size', 1000)
         self.path_encoding = settings.get('path_encoding')
+        self.inline_max_doc_size = settings.get('inline_max_doc_size')
+        self.pipeline_settings = settings.get('pipeline', {})
+
+        bulk_settings = settings.get('bulk', {})
+        self.bulk_threads = bulk_settings.get('thread_count', 1)
+        self.bulk_queue_size = bulk_settings.get('queue_size', 4)
+
+        # shared by the bulk threads, and learns across calls
+        self.sizer = AdaptiveBulkSizer.from_settings(settings)
 
         self.actions = []
+        self._counts_lock = threading.Lock()
 
         log.debug('ESStorer instance created: %s', self.client)
 
@@ -112,15 +168,109 @@ class ESStorer(object):
 
         return result
 
-    def partial_update_from_query(
-            self, index, query, transform, last_updated=True):
+    @staticmethod
+    def changes(original, doc_body):
+        """Fields of `doc_body` whose value differs from `original`"""
+        return dict(
+                (k, v) for k, v in doc_body.items()
+                if k != '_id' and original.get(k, _MISSING) != v)
+
+    def _count(self, counts, **kwargs):
+        with self._counts_lock:
+            for k, v in kwargs.items():
+                counts[k] = counts.get(k, 0) + v
+
+    def _update_ops(
+            self, index, docs, transform, failures, last_updated=True,
+            batch=False, skip_unchanged=False, counts=None):
+        """
+        Transform `docs` (dicts carrying their `_id`) and yield the
+        respective partial-update operations, as (ID, encoded operation)
+        pairs; failed IDs go in `failures`.
+
+        With `batch`, `transform` is called on pages of `bulk_size` docs
+        and returns one result per doc (an exception for failed docs).
+
+        With `skip_unchanged`, only the fields that differ from the doc are
+        written, and docs without such fields are not written at all; the
+        numbers of written and skipped docs are added to `counts`.
+        """
+        now = datetime.now()
+        written, skipped = 0, 0
+
+        for page in self._pages(docs, self.bulk_size if batch else 1):
+            try:
+                if batch:
+                    log.debug('Invoking transform on %d docs', len(page))
+                    bodies = transform(page)
+                else:
+                    log.debug('Invoking transform on ID = %s',
+                              page[0].get('_id'))
+                    bodies = [transform(page[0])]
+            except Exception as e:
+                log.warn('Error while transforming %d docs: %s', len(page), e)
+                bodies = [e] * len(page)
 
-        gc.collect()
-        err_ids = []
+            for data, doc_body in zip(page, bodies):
+                _id = data.get('_id')
 
-        def it():
-            batch = []
+                log.debug('Working on doc %s', data)
+
+                try:
+                    if isinstance(doc_body, Exception):
+                        raise doc_body
+
+                    if doc_body and skip_unchanged:
+                        doc_body = self.changes(data, doc_body)
+                        if not doc_body:
+                            log.debug('Doc ID = %s is unchanged', _id)
+                            skipped += 1
+
+                    if doc_body:
+                        if last_updated:
+                            doc_body['last_updated'] = now
+
+                        op = self.partial_update_op(
+                                doc_id=_id,
+                                index=index,
+                                doc_body=doc_body,
+                                doc_type=self.doc_type)
+
+                        # a doc that cannot be encoded fails on its own
+                        line = encode_op(op)
+                        written += 1
+                        yield _id, line
+                except Exception as e:
+                    log.warn('Cannot process doc ID = %s: %s', _id, e)
+                    failures[_id] = TRANSFORM_ERROR
+
+        if counts is not None:
+            self._count(counts, written=written, skipped=skipped)
+
+    @staticmethod
+    def _pages(it, size):
+        page = []
+        for item in it:
+            page.append(item)
+            if len(page) >= size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def partial_update_from_query(
+            self, index, query, transform, last_updated=True, source=None,
+            batch=False, skip_unchanged=False):
+        """
+        Transform the docs matching `query` and update them in place; with
+        `source` (a list of fields), only those fields are fetched. See
+        `_update_ops` for `batch` and `skip_unchanged`.
+        """
+        gc.collect()
+        failures = {}
+        counts = {}
 
+        def fetch():
             log.info('Received query: %s', query)
 
             s = Search(
@@ -129,66 +279,90 @@ class ESStorer(object):
                     doc_type=self.doc_type)
             s = s.update_from_dict(query)
 
+            if source is not None:
+                s = s.source(source)
+
             log.info('Running query: %s', s.to_dict())
 
-            # this loop shold spin `bulk_size` times
             for doc in s.scan():
-                batch.append(doc)
-
-            log.info('Accumulated %d items', len(batch))
-
-            for doc in batch:
                 data = doc.to_dict()
-                _id = doc.meta.id
-                data['_id'] = _id
-
-                log.debug('Working on doc %s', data)
+                data['_id'] = doc.meta.id
+                yield data
 
-                try:
-                    try:
-                        doc_body = transform(data)
-                        log.debug('Invoking transform on ID = %s', _id)
-                    except Exception as e:
-                        log.warn(
-                            'Error while transforming doc ID = %s: %s',
-                            _id, e)
-                        raise e
-
-                    if doc_body:
-                        if last_updated:
-                            doc_body['last_updated'] = datetime.now()
+        def ops(docs):
+            return self._update_ops(
+                    index, docs, transform, failures, last_updated, batch,
+                    skip_unchanged, counts)
 
-                        op = self.partial_update_op(
-                                doc_id=_id,
-                                index=index,
-                                doc_body=doc_body,
-                                doc_type=self.doc_type)
-                        yield op
-                except Exception as e:
-                    log.warn('Cannot process doc ID = %s: %s', _id, e)
-                    err_ids.append(_id)
-            del(batch)
+        # fetch, transform and bulk-write overlap instead of waiting on
+        # each other, and only the queued docs are held in memory
+        pipeline = StagedPipeline(**self.pipeline_settings)
 
+        # a failed scroll or bulk leaves docs unprocessed that are not in
+        # `failures`: raise, so that the whole task is retried
         try:
-            # call the iterator via bulk
-            self.bulk(it())
-            log.info('Invoking self.bulk(it())')
+            _, res_err = pipeline.run(fetch(), ops, self.bulk)
         except Exception as e:
             log.warn('Error in bulk on query = %s because: %s', query, e)
+            raise
+
+        log.info('Invoked self.bulk() on staged pipeline')
+        failures.update(self.bulk_failures(res_err))
+
+        log.info(
+                'Written %d docs, skipped %d unchanged docs',
+                counts.get('written', 0), counts.get('skipped', 0))
+
+        return failures
+
+    def partial_update_from_docs(
+            self, index, docs, transform, last_updated=True, batch=False,
+            skip_unchanged=False):
+        """
+        Like `partial_update_from_query`, but on documents that the caller
+        already holds (e.g., shipped inline in the task payload): no read
+        is issued against the index
+        """
+        gc.collect()
+        failures = {}
+        counts = {}
+
+        def it():
+            log.info('Received %d inline docs', len(docs))
+
+            for hit in docs:
+                data = dict(hit.get('_source', {}))
+                data['_id'] = hit.get('_id')
+
+                yield data
+
+        _, res_err = self.bulk(self._update_ops(
+            index, it(), transform, failures, last_updated, batch,
+            skip_unchanged, counts))
+        log.info('Invoked self.bulk() on inline docs')
+        failures.update(self.bulk_failures(res_err))
+
+        log.info(
+                'Written %d docs, skipped %d unchanged docs',
+                counts.get('written', 0), counts.get('skipped', 0))
 
-        return err_ids
+        return failures
 
     def bulk_index_from_it(
-            self, index, it, transform=lambda x: x, last_updated=True):
+            self, index, it, transform=lambda x: x, last_updated=True,
+            id_field=None):
 
+        id_field = id_field or self.id_field
         gc.collect()
-        err_ids = []
+        failures = {}
 
         def _it():
+            now = datetime.now()
+
             for doc_body in it:
                 try:
                     log.debug('Working on record: %s', doc_body)
-                    _id = doc_body.get(self.id_field)
+                    _id = doc_body.get(id_field)
 
                     try:
                         doc_body = transform(doc_body)
@@ -200,25 +374,23 @@ class ESStorer(object):
 
                     if doc_body:
                         if last_updated:
-                            doc_body['last_updated'] = datetime.now()
+                            doc_body['last_updated'] = now
 
                         op = self.partial_index_op(
                                 doc_id=_id,
                                 index=index,
                                 doc_body=doc_body,
                                 doc_type=self.doc_type)
-                        yield op
+                        yield _id, encode_op(op)
                 except Exception as e:
                     log.warn('Cannot process doc ID = %s: %s', _id, e)
-                    err_ids.append(_id)
+                    failures[_id] = TRANSFORM_ERROR
 
-        try:
-            self.bulk(_it())
-            log.info('Invoked self.bulk(_it())')
-        except Exception as e:
-            log.warn('Error in bulk index because: %s', e)
+        _, res_err = self.bulk(_it())
+        log.info('Invoked self.bulk(_it())')
+        failures.update(self.bulk_failures(res_err))
 
-        return err_ids
+        return failures
 
     def create_op(
                 self, doc_id, index, doc_body, op_type='update',
@@ -230,8 +402,7 @@ class ESStorer(object):
             doc_type = self.doc_type
 
         # remove _id
-        if '_id' in doc_body:
-            del(doc_body['_id'])
+        doc_body.pop('_id', None)
 
         if op_type == 'update':
             body = {
@@ -240,7 +411,7 @@ class ESStorer(object):
         else:
             body = doc_body
 
-        op_template = {
+        return {
             '_id': doc_id,
             '_op_type': op_type,
             '_retry_on_conflict': 3,
@@ -249,8 +420,6 @@ class ESStorer(object):
             '_source': body
         }
 
-        return op_template.copy()
-
     def partial_index_op(self, doc_id, index, doc_body, doc_type=None):
         return self.create_op(
                 doc_id=doc_id,
@@ -277,27 +446,167 @@ class ESStorer(object):
             log.warn('Cannot index %s because: %s', doc_id, e)
 
     def bulk(self, it):
+        """
+        Send the operations in `it` (dicts, or (ID, encoded operation)
+        pairs) in chunks sized by `self.sizer`; with `bulk.thread_count`
+        > 1, several chunks are in flight at once over the client's
+        connection pool. Return the number of successful operations and
+        the list of failed ones; errors that are not about single items
+        (e.g., a failing iterator) are raised.
+        """
+        res_succ, res_err = 0, []
+
         try:
             log.info('Sending bulk request on iterable/generator')
-            args = dict(client=self.client,
-                        actions=it,
-                        chunk_size=self.bulk_size,
-                        raise_on_exception=False,
-                        raise_on_error=False,
-                        stats_only=False,
-                        request_timeout=self.timeout)
 
-            res_succ, res_err = helpers.bulk(**args)
+            chunks = self._chunks(it)
+
+            if self.bulk_threads > 1:
+                pipeline = StagedPipeline(
+                        transform_threads=self.bulk_threads,
+                        fetch_queue_size=self.bulk_queue_size,
+                        write_queue_size=self.bulk_queue_size)
+                results = []
+                pipeline.run(
+                        chunks,
+                        lambda cs: (self._send_chunk(c) for c in cs),
+                        results.extend)
+            else:
+                results = (self._send_chunk(c) for c in chunks)
+
+            for succ, err in results:
+                res_succ += succ
+                res_err.extend(err)
 
             log.info(
                     'Sent bulk request on queue iterator: '
                     'successfull ops = %d, failed ops = %d',
                     res_succ, len(res_err))
+            log.info('Bulk sizing: %s', self.sizer.snapshot())
 
             for res in res_err:
                 log.warn('Error response: %s', res)
         except Exception as e:
+            # the caller must not take a lost chunk for a success
             log.error('Error in storing: %s', e, exc_info=True)
+            raise
+
+        return res_succ, res_err
+
+    def _chunks(self, it):
+        """
+        Encode operations to NDJSON, unless already encoded, and group
+        them in chunks of (ID, encoded operation) as large as the sizer
+        allows
+        """
+        chunk, chunk_bytes = [], 0
+
+        for op in it:
+            if isinstance(op, tuple):
+                _id, line = op
+            else:
+                _id, line = op['_id'], encode_op(op)
+            chunk.append((_id, line))
+            chunk_bytes += len(line)
+
+            if len(chunk) >= self.sizer.chunk_size or \
+                    chunk_bytes >= self.sizer.chunk_bytes:
+                yield chunk
+                chunk, chunk_bytes = [], 0
+
+        if chunk:
+            yield chunk
+
+    def _bulk_request(self, chunk):
+        """
+        Send one pre-encoded bulk body; return the number of successful
+        items and the failed ones, in the format of `helpers.bulk`
+        """
+        body = b''.join(line for _, line in chunk)
+
+        try:
+            resp = self.client.bulk(body=body, request_timeout=self.timeout)
+        except TransportError as e:
+            log.warn('Bulk request of %d items failed: %s', len(chunk), e)
+            return 0, [
+                    dict(bulk=dict(
+                        _id=_id, status=e.status_code, error=str(e)))
+                    for _id, _ in chunk]
+
+        items = resp.get('items', [])
+
+        if not resp.get('errors'):
+            return len(items), []
+
+        succ, err = 0, []
+        for item in items:
+            for op_type, info in item.items():
+                if 200 <= info.get('status', 500) < 300:
+                    succ += 1
+                else:
+                    err.append(item)
+
+        return succ, err
+
+    def _send_chunk(self, chunk):
+        """
+        Send one chunk of (ID, encoded operation) pairs; items rejected
+        because of overload are sent again after backing off, up to
+        `sizer.max_retries` times
+        """
+        res_succ, res_err = 0, []
+        attempt = 0
+
+        if self.sizer.backoff:
+            time.sleep(self.sizer.backoff)
+
+        while chunk:
+            t0 = time.time()
+            succ, err = self._bulk_request(chunk)
+            latency = time.time() - t0
+
+            rejected = set(
+                    _id for _id, status in self.bulk_failures(err).items()
+                    if status == 429)
+
+            self.sizer.record(
+                    latency,
+                    n_docs=len(chunk),
+                    n_bytes=sum(len(line) for _, line in chunk),
+                    rejected=len(rejected))
+
+            res_succ += succ
+
+            if not rejected or attempt >= self.sizer.max_retries:
+                res_err.extend(err)
+                break
+
+            res_err.extend(e for e in err if self._item_id(e) not in rejected)
+            chunk = [(_id, line) for _id, line in chunk if _id in rejected]
+            attempt += 1
+
+            log.warn(
+                    'Bulk: %d items rejected, retrying in %.1fs (attempt %d)',
+                    len(rejected), self.sizer.backoff, attempt)
+            time.sleep(self.sizer.backoff)
+
+        return res_succ, res_err
+
+    @staticmethod
+    def _item_id(item):
+        for op_type, info in item.items():
+            return info.get('_id')
+
+    @staticmethod
+    def bulk_failures(res_err):
+        """Map the failed items of a bulk response to {_id: status}"""
+        failures = {}
+
+        for item in res_err:
+            for op_type, info in item.items():
+                failures[info.get('_id')] = info.get('status')
+
+        return failures
 
     def get_fields(self, index):
         return self.client.indices.get_mapping(index, doc_type=self.doc_type)
@@ -315,7 +624,8 @@ class ESStorer(object):
         except Exception as e:
             log.warn('Cannot count: %s', e)
 
-    def scan(self, index, query, limit=None, id_only=False):
+    def scan(self, index, query, limit=None, id_only=False, slice_id=None,
+             max_slices=None, source=None):
         size = self.bulk_size
         max_records = None
         cnt = 0
@@ -333,6 +643,13 @@ class ESStorer(object):
 
         if id_only:
             kw['_source'] = ['_id']
+        elif source is not None:
+            kw['_source'] = source
+
+        if max_slices and max_slices > 1:
+            kw['query'] = dict(
+                    query,
+                    slice=dict(id=slice_id, max=max_slices))
 
         log.debug('Scanning for %s (size = %d, index = %s)',
                   query, size, index)
@@ -352,10 +669,27 @@ class ESStorer(object):
             else:
                 yield hit
 
-    def paginate(self, index, q='*', limit=None, size=None, id_only=True):
+    def paginate(self, index, q='*', limit=None, size=None, id_only=True,
+                 source=None, max_doc_size=None, slice_id=None,
+                 max_slices=None, scroll='20m'):
+        """
+        Yield pages (iterators) of hits matching `q`, through a scroll kept
+        open for `scroll` between pages.
+
+        With `max_slices`, only slice `slice_id` of the scroll is visited,
+        so that several consumers can scroll the same query in parallel.
+
+        With `id_only`, pages carry bare IDs. With `source` (`True` or a
+        list of fields), pages carry `{'_id', '_source'}` hits instead, so
+        the consumer does not have to read the documents again; hits whose
+        encoded `_source` exceeds `max_doc_size` bytes degrade to bare IDs.
+        """
         if not size:
             size = self.bulk_size
 
+        if max_doc_size is None:
+            max_doc_size = self.inline_max_doc_size
+
         log.info('Limit %s, size %s (q = "%s")', limit, size, q)
 
         s = Search(
@@ -369,10 +703,17 @@ class ESStorer(object):
             s = s.extra(size=size)
 
         s = s.params(
-                scroll='20m',
+                scroll=scroll,
                 size=size)
 
-        if id_only:
+        if max_slices and max_slices > 1:
+            s = s.extra(slice=dict(id=slice_id, max=max_slices))
+
+        if source:
+            id_only = False
+            if source is not True:
+                s = s.source(list(source))
+        elif id_only:
             s = s.source(False)
 
         log.debug('Query: %s', simplejson.dumps(s.to_dict(), indent=2))
@@ -388,6 +729,8 @@ class ESStorer(object):
             if overall < limit or not limit:
                 if id_only:
                     hits.append(h.meta.id)
+                elif source:
+                    hits.append(self._inline_hit(h, max_doc_size))
                 else:
                     hits.append(h.to_dict())
 
@@ -401,5 +744,136 @@ class ESStorer(object):
         else:
             raise StopIteration()
 
+    def paginate_after(self, index, q='*', limit=None, size=None,
+                       id_only=True, source=None, max_doc_size=None,
+                       after=None, sort_field='_id', pit=False, pit_id=None,
+                       keep_alive='5m', wait=None):
+        """
+        Like `paginate`, but page with a `search_after` cursor instead of a
+        scroll: yield `(page, cursor)` pairs, where `cursor` holds the
+        `after` values (and `pit_id`) that resume right after `page`.
+
+        Without a point in time, pages are sorted on `sort_field`, which
+        must be unique and sortable: `_id` needs fielddata on `_id`, which
+        loads on-heap and is disabled by default since ES 8, so prefer a
+        keyword field holding the ID. The cursor then survives any restart.
+
+        With `pit` (ES >= 7.12), pages are read from a point in time, for
+        a consistent view of the index, sorted on `_shard_doc`: resuming
+        needs `pit_id` to be still open, i.e., within `keep_alive`. The
+        point in time is closed only once all pages are read.
+
+        `wait` (e.g., `QueueThrottle.wait`) is called before reading each
+        page but the first, with a function that keeps the point in time
+        open, should it block for long.
+        """
+        if not size:
+            size = self.bulk_size
+
+        if max_doc_size is None:
+            max_doc_size = self.inline_max_doc_size
+
+        if limit:
+            size = min(size, limit)
+
+        log.info('Limit %s, size %s, after %s (q = "%s")',
+                 limit, size, after, q)
+
+        if pit and not pit_id:
+            try:
+                pit_id = self.client.open_point_in_time(
+                        index=index, keep_alive=keep_alive)['id']
+            except (AttributeError, TransportError) as e:
+                log.warn('Cannot open a point in time, going without: %s', e)
+
+        if source:
+            id_only = False
+
+        def touch():
+            if pit_id:
+                Search(using=self.client).extra(
+                        pit=dict(id=pit_id, keep_alive=keep_alive),
+                        size=0).execute()
+
+        overall = 0
+
+        while not limit or overall < limit:
+            if overall and wait is not None:
+                wait(touch)
+
+            if pit_id:
+                s = Search(using=self.client)
+                s = s.extra(pit=dict(id=pit_id, keep_alive=keep_alive))
+                s = s.sort('_shard_doc')
+            else:
+                s = Search(
+                        using=self.client,
+                        index=index,
+                        doc_type=self.doc_type)
+                s = s.sort(sort_field)
+
+            s = s.query(Q('query_string', query=q)).extra(size=size)
+
+            if after is not None:
+                s = s.extra(search_after=list(after))
+
+            if source and source is not True:
+                s = s.source(list(source))
+            elif id_only:
+                s = s.source(False)
+
+            try:
+                res = s.execute()
+            except TransportError as e:
+                if pit_id and e.status_code == 404:
+                    log.error(
+                            'Point in time %s expired: cannot resume', pit_id)
+                raise
+
+            pit_id = getattr(res, 'pit_id', None) or pit_id
+
+            hits = list(res)
+            if limit:
+                hits = hits[:limit - overall]
+
+            if not hits:
+                break
+
+            if id_only:
+                page = [h.meta.id for h in hits]
+            elif source:
+                page = [self._inline_hit(h, max_doc_size) for h in hits]
+            else:
+                page = [h.to_dict() for h in hits]
+
+            after = list(hits[-1].meta.sort)
+            overall += len(hits)
+
+            yield iter(page), dict(after=after, pit_id=pit_id)
+
+            if len(hits) < size:
+                break
+
+        # left open if interrupted, so that the run can be resumed
+        if pit_id:
+            try:
+                self.client.close_point_in_time(body=dict(id=pit_id))
+            except Exception as e:
+                log.debug('Cannot close point in time: %s', e)
+
+    def _inline_hit(self, h, max_doc_size=None):
+        """Return `h` as an inline hit, or its ID if it is too large"""
+        _source = h.to_dict()
+
+        if max_doc_size:
+            size = len(simplejson.dumps(_source))
+            if size > max_doc_size:
+                log.debug(
+                        'Doc ID = %s is too large to ship inline (%d bytes)',
+                        h.meta.id, size)
+                return h.meta.id
+
+        return dict(_id=h.meta.id, _source=_source)
+
 
 ES = ESStorer
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+# built-in modules
+import logging
+from datetime import date
+
+log = logging.getLogger(__name__)
+
+
+def _default(obj):
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+# use the fastest JSON library available: all of them return UTF-8 bytes
+try:
+    import orjson
+
+    JSON_BACKEND = 'orjson'
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default)
+except ImportError:
+    import simplejson
+
+    JSON_BACKEND = 'simplejson'
+
+    def dumps(obj):
+        return simplejson.dumps(
+                obj,
+                default=_default,
+                separators=(',', ':')).encode('utf-8')
+
+log.debug('Bulk encoder JSON backend: %s', JSON_BACKEND)
+
+
+def encode_op(op):
+    """
+    Encode a bulk operation (see `ESStorer.create_op`) as its NDJSON
+    action and source lines, ready to be concatenated in a bulk body
+    """
+    op_type = op.get('_op_type', 'index')
+
+    meta = {'_id': op['_id'], '_index': op['_index']}
+
+    if op.get('_type'):
+        meta['_type'] = op['_type']
+
+    if op_type == 'update' and '_retry_on_conflict' in op:
+        meta['retry_on_conflict'] = op['_retry_on_conflict']
+
+    line = dumps({op_type: meta}) + b'\n'
+
+    if op_type == 'delete':
+        return line
+
+    return line + dumps(op['_source']) + b'\n'
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+from __future__ import division
+
+# built-in modules
+import time
+import logging
+import threading
+
+# 3rd party modules
+from six.moves import queue
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class StagedPipeline(object):
+    """
+    Fetch, transform and write stages, overlapped via bounded queues.
+
+    One thread drains `source` into the fetch queue, `transform_threads`
+    threads turn the fetched items into operations on the write queue, and
+    the calling thread hands the operations to `sink`. The queue bounds cap
+    the memory in flight; the maximum depth of each queue is recorded in
+    `stats`, to tell which stage is the bottleneck.
+    """
+    def __init__(self, transform_threads=1, fetch_queue_size=1000,
+                 write_queue_size=1000):
+        self.transform_threads = max(1, int(transform_threads))
+        self.fetch_q = queue.Queue(maxsize=fetch_queue_size)
+        self.write_q = queue.Queue(maxsize=write_queue_size)
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._errors = []
+
+        self.stats = dict(
+                fetched=0,
+                transformed=0,
+                fetch_queue_size=fetch_queue_size,
+                write_queue_size=write_queue_size,
+                fetch_queue_max_depth=0,
+                write_queue_max_depth=0,
+                transform_threads=self.transform_threads)
+
+    def _put(self, q, item, depth_key):
+        # time out periodically, in case the downstream stage is gone
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=1.0)
+                break
+            except queue.Full:
+                continue
+
+        depth = q.qsize()
+        if depth > self.stats[depth_key]:
+            self.stats[depth_key] = depth
+
+    def _drain(self, q, producers=1):
+        done = 0
+        while done < producers:
+            try:
+                item = q.get(timeout=1.0)
+            except queue.Empty:
+                if self._stop.is_set():
+                    break
+                continue
+
+            if item is _DONE:
+                done += 1
+                continue
+            yield item
+
+    def _fetch(self, source):
+        try:
+            for item in source:
+                if self._stop.is_set():
+                    break
+                self.stats['fetched'] += 1
+                self._put(self.fetch_q, item, 'fetch_queue_max_depth')
+        except Exception as e:
+            log.warn('Fetch stage failed: %s', e)
+            self._errors.append(e)
+        finally:
+            for _ in range(self.transform_threads):
+                self._put(self.fetch_q, _DONE, 'fetch_queue_max_depth')
+
+    def _transform(self, transform):
+        try:
+            for op in transform(self._drain(self.fetch_q)):
+                with self._lock:
+                    self.stats['transformed'] += 1
+                self._put(self.write_q, op, 'write_queue_max_depth')
+        except Exception as e:
+            log.warn('Transform stage failed: %s', e)
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            self._put(self.write_q, _DONE, 'write_queue_max_depth')
+
+    def run(self, source, transform, sink):
+        """
+        Feed `source` through `transform` (a function from an iterable of
+        items to an iterable of operations) into `sink` (a function that
+        consumes an iterable of operations); return `sink`'s result
+        """
+        t0 = time.time()
+
+        threads = [threading.Thread(
+            target=self._fetch,
+            args=(source,),
+            name='dpx-fetch')]
+
+        for i in range(self.transform_threads):
+            threads.append(threading.Thread(
+                target=self._transform,
+                args=(transform,),
+                name='dpx-transform-{}'.format(i)))
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            res = sink(self._drain(self.write_q, self.transform_threads))
+        finally:
+            # unblock the upstream stages if the sink gave up early
+            self._stop.set()
+
+        for t in threads:
+            t.join()
+
+        self.stats['elapsed'] = time.time() - t0
+
+        log.info('Staged pipeline stats: %s', self.stats)
+
+        if self._errors:
+            raise self._errors[0]
+
+        return res
@@ -31,7 +31,10 @@
 import logging
 
 from celery import Celery
-from celery.signals import setup_logging
+from celery.signals import (
+        setup_logging,
+        worker_process_init,
+        worker_process_shutdown)
 
 from defplorex.celeryconfig import broker_url, result_backend, timezone
 
@@ -52,4 +55,19 @@ def _setup_logging(loglevel=logging.WARN, **kwargs):
             broker_url, result_backend, timezone)
 
 
+@worker_process_init.connect
+def _setup_registry(**kwargs):
+    from defplorex.worker import registry
+    from defplorex.transformer import TransformerFactory
+
+    classes = [cls for _, cls in TransformerFactory.get_classes()]
+    registry.setup(transformer_classes=classes)
+
+
+@worker_process_shutdown.connect
+def _teardown_registry(**kwargs):
+    from defplorex.worker import registry
+    registry.teardown()
+
+
 app.log.setup()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+# built-in modules
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def binned_field(feature, field='bins', suffix=''):
+    """
+    Field holding the bin of `feature` (full field names pass as is); with
+    `suffix`, its sub-field (e.g., `.keyword` to aggregate on it)
+    """
+    if '.' in feature:
+        return feature
+    return '{}.{}{}'.format(field, feature, suffix)
+
+
+def clusters(client, index, fields, q='*', size=1000, min_size=1,
+             doc_type=None):
+    """
+    Group the docs matching `q` by the values of `fields` (e.g., binned
+    features), yielding `(key, doc_count)` for each group with at least
+    `min_size` docs.
+
+    Groups are paged through with a composite aggregation, `size` at a
+    time, so neither ES nor this process hold the whole bucket space.
+    `fields` must be keyword (or numeric) fields; docs that miss some of
+    them are grouped under a `None` value.
+    """
+    composite = dict(
+            size=size,
+            sources=[
+                dict([(f, dict(terms=dict(field=f, missing_bucket=True)))])
+                for f in fields])
+
+    body = dict(
+            size=0,
+            query=dict(query_string=dict(query=q)),
+            aggs=dict(clusters=dict(composite=composite)))
+
+    pages = 0
+    while True:
+        res = client.search(index=index, doc_type=doc_type, body=body)
+        agg = res['aggregations']['clusters']
+        pages += 1
+
+        for bucket in agg['buckets']:
+            if bucket['doc_count'] >= min_size:
+                yield bucket['key'], bucket['doc_count']
+
+        after = agg.get('after_key')
+        if not agg['buckets'] or after is None:
+            break
+
+        composite['after'] = after
+
+    log.info('Read %d pages of clusters', pages)
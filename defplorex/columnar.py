@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+from __future__ import division
+
+# built-in modules
+import os
+import logging
+
+# 3rd party modules
+import simplejson
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+ID_COLUMN = '_id'
+MISSING_BIN = -1
+
+
+def _get(doc, field):
+    # dotted field names reach into nested objects
+    for k in field.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(k)
+    return doc
+
+
+class ColumnStore(object):
+    """
+    On-disk columnar copy of the features, for offline analysis.
+
+    Each column is a raw array file in directory `path` that `load()` maps
+    in memory, without copies: numeric features are float64 (NaN when
+    missing), binned features are int8 label codes (-1 when missing) and
+    the IDs are a UTF-8 blob plus an int64 offsets column. `meta.json`
+    holds the number of committed rows, so an interrupted append is
+    dropped at the next one.
+
+    Rows are only appended: a refreshed doc appears again, and its latest
+    row wins (see `Columns.latest()`).
+    """
+    def __init__(self, path):
+        if np is None:
+            raise ImportError('The column store needs numpy')
+
+        self.path = os.path.expanduser(path)
+
+    @classmethod
+    def from_settings(cls, settings):
+        cfg = settings.get('columnar', {})
+        return cls(cfg.get('path', '~/.dpx-columns'))
+
+    def _fname(self, name):
+        return os.path.join(self.path, name)
+
+    def meta(self):
+        """Metadata of the store, `None` if nothing was exported yet"""
+        fname = self._fname('meta.json')
+        if not os.path.exists(fname):
+            return None
+
+        with open(fname) as f:
+            return simplejson.load(f)
+
+    def _save_meta(self, meta):
+        fname = self._fname('meta.json')
+        with open(fname + '.tmp', 'w') as f:
+            simplejson.dump(meta, f, indent=2, sort_keys=True)
+        os.rename(fname + '.tmp', fname)
+
+    def reset(self):
+        meta = self.meta()
+        if meta is None:
+            return
+
+        for name in list(meta['columns']) + ['ids', 'offsets', 'meta.json']:
+            if os.path.exists(self._fname(name)):
+                os.remove(self._fname(name))
+
+    def _files(self, meta):
+        # (file name, dtype, size of the committed part)
+        yield 'offsets', 'int64', meta['rows'] * 8
+        yield 'ids', 'uint8', meta['id_bytes']
+        for name, col in meta['columns'].items():
+            size = meta['rows'] * np.dtype(col['dtype']).itemsize
+            yield name, col['dtype'], size
+
+    def append(self, hits, numeric=(), binned=(), labels=(),
+               chunk_size=10000, watermark=None):
+        """
+        Append the features of `hits` (`{'_id', '_source'}`), returning
+        the number of rows written. The columns and labels are fixed by
+        the first export.
+
+        Once all the hits are in, `watermark` is stored: the time after
+        which docs must be exported again by the next refresh.
+        """
+        meta = self.meta()
+
+        if meta is None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            meta = dict(rows=0, id_bytes=0, watermark=None,
+                        labels=list(labels), columns={})
+            for f in numeric:
+                meta['columns'][f] = dict(kind='numeric', dtype='float64')
+            for f in binned:
+                meta['columns'][f] = dict(kind='binned', dtype='int8')
+
+        # drop what an interrupted append left behind
+        for name, _, size in self._files(meta):
+            with open(self._fname(name), 'ab') as f:
+                f.truncate(size)
+
+        codes = dict((l, i) for i, l in enumerate(meta['labels']))
+        columns = sorted(meta['columns'].items())
+        rows = 0
+
+        def flush(chunk):
+            values = dict((name, []) for name, _ in columns)
+            ids = []
+
+            for hit in chunk:
+                source = hit.get('_source', {})
+                ids.append(hit['_id'].encode('utf-8'))
+
+                for name, col in columns:
+                    v = _get(source, name)
+                    if col['kind'] == 'binned':
+                        v = codes.get(v, MISSING_BIN)
+                    elif v is None or isinstance(v, bool):
+                        v = np.nan
+                    values[name].append(v)
+
+            for name, col in columns:
+                with open(self._fname(name), 'ab') as f:
+                    f.write(np.asarray(
+                        values[name], dtype=col['dtype']).tobytes())
+
+            # each ID ends where the next one starts
+            ends = meta['id_bytes'] + np.cumsum([len(i) for i in ids])
+            with open(self._fname('offsets'), 'ab') as f:
+                f.write(ends.astype('int64').tobytes())
+            with open(self._fname('ids'), 'ab') as f:
+                f.write(b''.join(ids))
+
+            meta['rows'] += len(chunk)
+            meta['id_bytes'] = int(ends[-1])
+            self._save_meta(meta)
+
+        chunk = []
+        for hit in hits:
+            chunk.append(hit)
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                rows += len(chunk)
+                chunk = []
+
+        if chunk:
+            flush(chunk)
+            rows += len(chunk)
+
+        # not before: an interrupted export must be refreshed from the
+        # previous watermark
+        if watermark is not None:
+            meta['watermark'] = watermark
+
+        # remember the columns, even if nothing was exported
+        self._save_meta(meta)
+
+        log.info('Appended %d rows (%d in total) to %s',
+                 rows, meta['rows'], self.path)
+
+        return rows
+
+    def load(self):
+        """Memory-mapped, read-only `Columns` of the store"""
+        meta = self.meta()
+        if meta is None:
+            raise IOError('No columns in {}'.format(self.path))
+
+        arrays = {}
+        for name, dtype, size in self._files(meta):
+            if not size:
+                arrays[name] = np.zeros(0, dtype=dtype)
+                continue
+
+            n = size // np.dtype(dtype).itemsize
+            arrays[name] = np.memmap(
+                    self._fname(name), dtype=dtype, mode='r', shape=(n,))
+
+        return Columns(meta, arrays)
+
+
+class Columns(object):
+    """
+    Read-only columns of a `ColumnStore`: `columns[feature]` is an array
+    with one value per row, `columns.id(row)` is the ID of a row
+    """
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        self.labels = meta['labels']
+        self._offsets = arrays.pop('offsets')
+        self._ids = arrays.pop('ids')
+        self._arrays = arrays
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    @property
+    def names(self):
+        return sorted(self._arrays)
+
+    def id(self, row):
+        start = self._offsets[row - 1] if row else 0
+        return self._ids[start:self._offsets[row]].tobytes().decode('utf-8')
+
+    def ids(self):
+        return [self.id(row) for row in range(len(self))]
+
+    def latest(self):
+        """Indices of the latest row of each ID, in row order"""
+        rows = {}
+        for row, _id in enumerate(self.ids()):
+            rows[_id] = row
+        return np.sort(np.fromiter(rows.values(), dtype='int64'))
@@ -30,9 +30,13 @@
 
 from __future__ import division
 
+import os
 import sys
 import time
+import hashlib
 import logging
+import itertools
+from datetime import datetime, timedelta
 
 # 3rd partymodules
 import click
@@ -44,8 +48,9 @@ from elasticsearch_dsl import Search, Q
 from defplorex.loggers import config_logger
 from defplorex.config import load_settings
 from defplorex.backend.elastic import ES
-from defplorex.transformer import TransformerFactory
+from defplorex.transformer import TagTransformer, TransformerFactory, Pipeline
 from defplorex.utils import (
+        Counter,
         SlowOverallFancyBar,
         SlowFancyBar,
         fopen)
@@ -89,6 +94,12 @@ def elastic():
     log.info('Elasticsearch commands')
 
 
+@cli.group()
+def features():
+    """Feature quantization and clustering commands"""
+    pass
+
+
 @process.command()
 @click.option(
         '--index', '-i',
@@ -116,50 +127,357 @@ def elastic():
 @click.option(
         '--ephemeral', '-e',
         is_flag=True, default=False, help='Dry run')
+@click.option(
+        '--inline', '-I',
+        is_flag=True, default=False, help='Ship documents in the task'
+        ' payload instead of IDs (saves one read per document)')
+@click.option(
+        '--field', '-f',
+        multiple=True,
+        metavar='F', help='Ship these fields inline, besides those that'
+        ' the transformers read (implies -I)')
+@click.option(
+        '--max-doc-size', '-M', type=int,
+        metavar='B', help='Ship larger documents by ID'
+        ' (default: setting "inline_max_doc_size")')
+@click.option(
+        '--slices', '-s', type=int, default=1,
+        metavar='N', help='Scroll N slices in parallel,'
+        ' one producer process each')
+@click.option(
+        '--checkpoint', '-C',
+        metavar='FILE', help='Save the cursor after each batch to FILE'
+        ' (default: one file per job in setting "enqueue.checkpoint_dir")')
+@click.option(
+        '--resume', '-R',
+        is_flag=True, default=False, help='Continue after the last batch'
+        ' saved in the checkpoint')
+@click.option(
+        '--stale-only', '-S',
+        is_flag=True, default=False, help='Only the records that miss the'
+        ' current version of the transformers, run with these arguments'
+        ' (e.g., the records not tagged with TAG yet)')
 @click.argument('q', metavar='<q>')
-def enqueue(index, transformer, limit, tag, reindex, now, ephemeral, q):
+def enqueue(index, transformer, limit, tag, reindex, now, ephemeral, inline,
+            field, max_doc_size, slices, checkpoint, resume, stale_only, q):
     """
     Read from index according to query, process, and write to index
     """
     if not transformer:
         log.warn('Please choose at least one transform among %s', TR)
 
-    from defplorex.tasks import processor_task
-
     log.info('Working on index %s', index)
 
     kwargs = dict(
             update=not reindex,
-            ephemeral=ephemeral)
+            ephemeral=ephemeral,
+            transformers_lst=transformer)
 
     if tag:
         kwargs.update(**dict(tag=tag))
 
-    # iterator that paginates through records
-    it = es.paginate(
+    # what a checkpoint is for: resuming must not mix different jobs
+    job = dict(
             index=index,
             q=q,
+            transformers=sorted(transformer),
+            tag=tag,
+            reindex=reindex,
+            stale_only=stale_only)
+
+    if stale_only:
+        # the versions of some transformers depend on their settings
+        stale = Pipeline.stale_query([
+            cls(settings=settings)
+            for cls in TransformerFactory.get_by_list(transformer)], kwargs)
+
+        if stale is None:
+            raise click.UsageError('None of the transformers is versioned')
+
+        q = '({}) AND {}'.format(q, stale)
+        log.info('Enqueuing stale records only: %s', q)
+
+    source = None
+    if field or inline:
+        # ship only what the transformers read, if they all declare it:
+        # partial updates of fields missing from `_source` would replace
+        # their stored values (e.g., the tags)
+        classes = [TagTransformer] + \
+                TransformerFactory.get_by_list(transformer)
+        fields = None
+        if not reindex:
+            fields = Pipeline.source_fields(classes)
+
+        if fields is None:
+            if field:
+                log.warn('Shipping whole documents: not all transformers'
+                         ' declare the fields they read')
+            source = True
+        else:
+            source = sorted(set(fields) | set(field))
+
+    pagination = dict(
+            index=index,
+            q=q,
+            id_only=True,
+            source=source,
+            max_doc_size=max_doc_size)
+
+    if slices > 1:
+        if resume:
+            raise click.UsageError('Cannot resume a sliced enqueue')
+        return _enqueue_sliced(
+                slices, limit, pagination, kwargs, now, ephemeral)
+
+    cfg = settings.get('enqueue', {})
+
+    if not checkpoint:
+        # one checkpoint per job, so that runs do not overwrite each other
+        path = os.path.expanduser(
+                cfg.get('checkpoint_dir', '~/.dpx-enqueue'))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        digest = hashlib.sha1(simplejson.dumps(
+            job, sort_keys=True).encode('utf-8')).hexdigest()
+        checkpoint = os.path.join(
+                path, '{}-{}.json'.format(index, digest[:12]))
+
+    saved = None
+    try:
+        with open(checkpoint) as f:
+            saved = simplejson.load(f)
+    except IOError:
+        pass
+
+    state = dict(job=job, cursor=None, enqueued=0, done=False)
+
+    if resume:
+        if saved is None:
+            raise click.UsageError('No checkpoint in {}'.format(checkpoint))
+
+        if saved['job'] != job:
+            raise click.UsageError(
+                    'Checkpoint {} is for another job: {}'.format(
+                        checkpoint, simplejson.dumps(saved['job'])))
+
+        if saved['done']:
+            log.info('Nothing to resume: the job is done')
+            return
+
+        state = saved
+        log.info('Resuming after %d enqueued records (cursor: %s)',
+                 state['enqueued'], state['cursor'])
+
+        if limit:
+            limit -= state['enqueued']
+            if limit <= 0:
+                return
+    elif saved is not None and not saved['done']:
+        log.warn('Starting over: the checkpoint of an interrupted run'
+                 ' (%d records enqueued) is replaced, use --resume to'
+                 ' continue it instead', saved['enqueued'])
+
+    def save():
+        with open(checkpoint + '.tmp', 'w') as f:
+            simplejson.dump(state, f)
+        os.rename(checkpoint + '.tmp', checkpoint)
+
+    log.info('Checkpoint: %s', checkpoint)
+
+    throttle = _throttle(now, ephemeral)
+
+    # iterator that pages through records with a durable cursor
+    cursor = state['cursor'] or {}
+    it = es.paginate_after(
             limit=limit,
-            id_only=True)
+            after=cursor.get('after'),
+            sort_field=cfg.get('cursor_field', '_id'),
+            pit=cfg.get('pit', False),
+            pit_id=cursor.get('pit_id'),
+            keep_alive=cfg.get('keep_alive', '30m'),
+            wait=throttle.wait if throttle else None,
+            **pagination)
+
+    # enqueue one task per page of records, then move the cursor past it
+    for page, cursor in it:
+        n = _enqueue_page(page, index, kwargs, now, ephemeral)
+
+        state.update(**dict(cursor=cursor, enqueued=state['enqueued'] + n))
+        save()
+
+        if throttle:
+            throttle.record(n)
+            click.echo(throttle.status())
 
-    # enqueue one task per page of records
-    for ids in it:
-        ids = list(ids)
-        click.echo('Launching task with {} IDs'.format(len(ids)))
+    state['done'] = True
+    save()
 
-        kwargs.update(**dict(transformers_lst=transformer))
+    if throttle:
+        throttle.close()
 
-        s = processor_task.s(ids, index, **kwargs)
 
-        if now:
-            res = s()
+def _throttle(now, ephemeral):
+    """Backpressure on the queue of the workers, unless running here"""
+    from defplorex.tasks import processor_task
+    from defplorex.throttle import QueueThrottle
+
+    if now or ephemeral:
+        return None
+
+    return QueueThrottle.from_settings(processor_task.app, settings)
+
+
+def _enqueue_page(page, index, kwargs, now, ephemeral, verbose=True):
+    """Launch one `processor_task` on a page of hits; return its size"""
+    from defplorex.tasks import processor_task
+
+    ids, docs = [], []
+    for hit in page:
+        if isinstance(hit, dict):
+            docs.append(hit)
         else:
-            res = s.delay()
-            if ephemeral:
-                res = res.get()
+            ids.append(hit)
+
+    if verbose:
+        click.echo('Launching task with {} IDs and {} inline docs'.format(
+            len(ids), len(docs)))
 
+    kwargs = kwargs.copy()
+    if docs:
+        kwargs.update(**dict(docs=docs))
+
+    s = processor_task.s(ids, index, **kwargs)
+
+    if now:
+        res = s()
+    else:
+        res = s.delay()
         if ephemeral:
-            click.echo(simplejson.dumps(res, indent=2))
+            res = res.get()
+
+    if ephemeral:
+        click.echo(simplejson.dumps(res, indent=2))
+
+    return len(ids) + len(docs)
+
+
+def _enqueue_slice(slice_id, slices, limit, pagination, kwargs, now,
+                   ephemeral, progress):
+    """Producer process: enqueue the pages of one scroll slice"""
+    # connections must not be shared with the parent process
+    _es = ES(settings)
+    throttle = _throttle(now, ephemeral)
+
+    # a scroll cannot be kept alive without reading on: pause for half of
+    # its timeout at most
+    timeout = settings.get('enqueue', {}).get('scroll_timeout', 1200)
+
+    try:
+        it = _es.paginate(
+                limit=limit,
+                slice_id=slice_id,
+                max_slices=slices,
+                scroll='{}s'.format(timeout),
+                **pagination)
+
+        for page in it:
+            if throttle:
+                throttle.wait(timeout=timeout / 2)
+
+            progress.put(_enqueue_page(
+                page, pagination['index'], kwargs, now, ephemeral,
+                verbose=False))
+    except Exception as e:
+        log.error('Slice %d/%d failed: %s', slice_id, slices, e,
+                  exc_info=True)
+        progress.put((slice_id, False))
+    else:
+        progress.put((slice_id, True))
+    finally:
+        if throttle:
+            throttle.close()
+
+
+def _enqueue_sliced(slices, limit, pagination, kwargs, now, ephemeral):
+    """Enqueue through `slices` producer processes, one progress bar"""
+    import multiprocessing
+    from six.moves import queue
+
+    s = Search(using=es.client, index=pagination['index'])
+    N = s.query(Q('query_string', query=pagination['q'])).count()
+
+    if limit:
+        N = min(N, limit)
+
+    log.info('Enqueuing %d records over %d slices', N, slices)
+
+    progress = multiprocessing.Queue()
+    producers = {}
+
+    for slice_id in range(slices):
+        _limit = None
+        if limit:
+            # spread the limit over the slices
+            _limit = limit // slices + (1 if slice_id < limit % slices else 0)
+            if not _limit:
+                continue
+
+        p = multiprocessing.Process(
+                target=_enqueue_slice,
+                args=(slice_id, slices, _limit, pagination, kwargs, now,
+                      ephemeral, progress))
+        p.start()
+        producers[slice_id] = p
+
+    bar = SlowFancyBar('', max=N)
+    running = set(producers)
+    failed = []
+
+    # the producers throttle themselves: only report the queue here
+    monitor = _throttle(now, ephemeral)
+    polled = 0
+
+    while running:
+        try:
+            n = progress.get(True, 1)
+        except queue.Empty:
+            # producers killed before reporting (e.g., out of memory)
+            for slice_id in sorted(running):
+                p = producers[slice_id]
+                if not p.is_alive() and p.exitcode != 0:
+                    log.error('Slice %d/%d died (exit code %s)',
+                              slice_id, slices, p.exitcode)
+                    running.discard(slice_id)
+                    failed.append(slice_id)
+            continue
+
+        if isinstance(n, tuple):
+            slice_id, ok = n
+            running.discard(slice_id)
+            if not ok:
+                failed.append(slice_id)
+            continue
+
+        if monitor:
+            monitor.record(n)
+            if time.time() - polled > monitor.interval:
+                monitor.depth()
+                polled = time.time()
+            bar.message = monitor.status() + ' '
+        bar.next(n)
+    bar.finish()
+
+    if monitor:
+        monitor.close()
+
+    for p in producers.values():
+        p.join()
+
+    if failed:
+        raise click.ClickException(
+                'Slices {} of {} failed: the enqueue is incomplete'.format(
+                    ', '.join(str(i) for i in sorted(failed)), slices))
 
 
 @process.command()
@@ -290,3 +608,633 @@ def monitor_clone_index(from_index, to_index):
         _cnt = Search(using=es.client, index=to_index).count()
         bar.goto(_cnt)
     bar.finish()
+
+
+@elastic.command(name='import')
+@click.option(
+        '--index', '-i',
+        help='Write to index',
+        metavar='F', default=INDEX)
+@click.option(
+        '--transformer', '-T',
+        multiple=True,
+        type=click.Choice(TR),
+        metavar='T',
+        help='Transformation: {}'.format(TR))
+@click.option(
+        '--tag', '-t',
+        metavar='TAG', help='Tag the records')
+@click.option(
+        '--id-field',
+        metavar='F', help='Field holding the doc ID, unless the records are'
+        ' {_id, _source} hits (default: setting "id_field")')
+@click.option(
+        '--processes', '-P', type=int, default=4,
+        metavar='N', help='Index through N processes')
+@click.option(
+        '--chunk-size', '-c', type=int, default=1000,
+        metavar='N', help='Records per chunk handed to a process')
+@click.option(
+        '--checkpoint', '-C',
+        metavar='FILE', help='Checkpoint file (default: <input>.ckpt)')
+@click.option(
+        '--resume', '-R',
+        is_flag=True, default=False, help='Resume from the checkpoint')
+@click.option(
+        '--rejects',
+        metavar='FILE', help='Append the records that failed to FILE'
+        ' (default: <input>.rejects.ndjson)')
+@click.argument('fname', metavar='<file>')
+def import_(index, transformer, tag, id_field, processes, chunk_size,
+            checkpoint, resume, rejects, fname):
+    """
+    Index the NDJSON records (optionally gzipped) of a file
+    """
+    import multiprocessing
+    from six.moves import queue
+
+    checkpoint = checkpoint or fname + '.ckpt'
+    rejects = rejects or fname + '.rejects.ndjson'
+    id_field = id_field or settings.get('id_field')
+
+    # offsets are in the uncompressed stream: gzip files seek in it too
+    state = dict(fname=fname, offset=0, docs=0, failed=0)
+
+    if resume:
+        try:
+            with open(checkpoint) as f:
+                state = simplejson.load(f)
+            log.info('Resuming from offset %d (%d docs done)',
+                     state['offset'], state['docs'])
+        except IOError:
+            log.warn('No checkpoint %s, starting over', checkpoint)
+
+    chunks = multiprocessing.Queue(processes * 2)
+    results = multiprocessing.Queue()
+    workers = []
+
+    for _ in range(processes):
+        p = multiprocessing.Process(
+                target=_import_chunks,
+                args=(chunks, results, index, id_field, transformer, tag))
+        p.start()
+        workers.append(p)
+
+    ends = {}
+    finished = {}
+    pending = [0]
+    counter = Counter('Imported')
+    start = time.time()
+    initial = state['docs']
+
+    def save():
+        with open(checkpoint + '.tmp', 'w') as f:
+            simplejson.dump(state, f)
+        os.rename(checkpoint + '.tmp', checkpoint)
+
+    def alive():
+        return any(p.is_alive() for p in workers)
+
+    def drain(block=False):
+        """Collect the results, return how many were there"""
+        got = 0
+        while True:
+            try:
+                n, docs, rejected = results.get(block, 1)
+            except queue.Empty:
+                return got
+            finished[n] = (docs, rejected)
+            got += 1
+            block = False
+
+            # the checkpoint only moves past chunks done in file order,
+            # once their failed records are safe in the rejects file
+            advanced = False
+            while pending[0] in finished:
+                docs, rejected = finished.pop(pending[0])
+                if rejected:
+                    with open(rejects, 'ab') as f:
+                        f.writelines(rejected)
+                state['offset'] = ends.pop(pending[0])
+                state['docs'] += docs
+                state['failed'] += len(rejected)
+                pending[0] += 1
+                advanced = True
+
+            if advanced:
+                save()
+                counter.update('{} docs, {} failed ({:.0f} docs/s)'.format(
+                    state['docs'], state['failed'],
+                    (state['docs'] - initial) / (time.time() - start)))
+
+    def put(item):
+        """Hand `item` to the workers, unless they are all gone"""
+        while alive():
+            try:
+                chunks.put(item, True, 1)
+                return True
+            except queue.Full:
+                # keep collecting results while the workers are busy
+                drain()
+        return False
+
+    with fopen(fname, 'rb') as f:
+        f.seek(state['offset'])
+
+        offset = state['offset']
+        n = pending[0]
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+
+            offset += sum(len(l) for l in lines)
+            ends[n] = offset
+
+            if not put((n, lines)):
+                log.error('All the import processes died')
+                break
+
+            n += 1
+            drain()
+
+    for _ in workers:
+        if not put(None):
+            break
+
+    # until every chunk is done, or nobody is left to do it
+    while ends:
+        if not drain(block=True) and not alive():
+            drain()
+            break
+
+    for p in workers:
+        p.join()
+
+    click.echo()
+
+    if ends:
+        log.error('Some chunks were not indexed: resume from offset %d',
+                  state['offset'])
+
+    if state['failed']:
+        log.warn('Failed records are in %s', rejects)
+
+    log.info('Indexed %d docs in %.1fs, %d failed',
+             state['docs'] - initial, time.time() - start, state['failed'])
+
+
+def _import_chunks(chunks, results, index, id_field, transformer, tag):
+    """Consumer process: index the chunks of records until `None`"""
+    from defplorex.worker import registry
+
+    # connections must not be shared with the parent process
+    _es = ES(settings)
+
+    transformers = [registry.transformer(TagTransformer)] + [
+            registry.transformer(cls)
+            for cls in TransformerFactory.get_by_list(transformer)]
+    kwargs = dict(settings=settings, requested=list(transformer))
+    if tag:
+        kwargs.update(**dict(tag=tag))
+
+    def transform(doc):
+        if not transformer and not tag:
+            return doc
+        return Pipeline.chain(doc, transformers, updates_only=False, **kwargs)
+
+    for chunk in iter(chunks.get, None):
+        n, lines = chunk
+        records, rejected = [], []
+
+        for line in lines:
+            if not line.strip():
+                continue
+
+            try:
+                doc = simplejson.loads(line)
+            except ValueError as e:
+                log.warn('Skipping invalid record: %s', e)
+                rejected.append(line)
+                continue
+
+            # {_id, _source} hits, as ES returns them
+            if '_source' in doc and '_id' in doc:
+                doc = dict(doc['_source'], _id=doc['_id'])
+            records.append((doc, line))
+
+        _id_field = '_id' if records and '_id' in records[0][0] \
+            else id_field
+
+        # records without an ID cannot be indexed
+        rejected.extend(l for d, l in records if not d.get(_id_field))
+        records = [(d, l) for d, l in records if d.get(_id_field)]
+
+        # taken now: indexing pops `_id` from the docs
+        ids = [d.get(_id_field) for d, _ in records]
+
+        try:
+            failures = _es.bulk_index_from_it(
+                    index,
+                    [d for d, _ in records],
+                    transform=transform,
+                    id_field=_id_field)
+        except Exception as e:
+            log.error('Cannot index chunk %d: %s', n, e)
+            failures = set(ids)
+
+        # count the failed records themselves, not their distinct IDs
+        failed = [l for _id, (_, l) in zip(ids, records) if _id in failures]
+        rejected.extend(failed)
+
+        results.put((n, len(records) - len(failed), rejected))
+
+
+@elastic.command(name='export')
+@click.option(
+        '--index', '-i',
+        help='Read from index',
+        metavar='F', default=INDEX)
+@click.option(
+        '--field', '-f',
+        multiple=True,
+        metavar='F', help='Export only these fields')
+@click.option(
+        '--slices', '-s', type=int, default=4,
+        metavar='N', help='Scroll N slices in parallel,'
+        ' one process and shard each')
+@click.option(
+        '--compression', '-z',
+        type=click.Choice(['gzip', 'zstd']), default='gzip',
+        help='Shard compression')
+@click.option(
+        '--output', '-o',
+        metavar='PREFIX', help='Shard file name prefix (default: index)')
+@click.argument('q', metavar='<q>', default='*')
+def export_(index, field, slices, compression, output, q):
+    """
+    Dump the documents matching a query to compressed NDJSON shards
+    """
+    import multiprocessing
+    from six.moves import queue
+
+    if compression == 'zstd':
+        try:
+            import zstandard  # noqa
+        except ImportError:
+            raise click.UsageError('zstd compression needs zstandard')
+
+    ext = dict(gzip='gz', zstd='zst')[compression]
+    output = output or index
+    query = dict(query=dict(query_string=dict(query=q)))
+    source = list(field) or None
+
+    N = Search(using=es.client, index=index).query(
+            Q('query_string', query=q)).count()
+
+    log.info('Exporting %d records over %d slices', N, slices)
+
+    progress = multiprocessing.Queue()
+    producers = {}
+    fnames = {}
+
+    for slice_id in range(slices):
+        fname = '{}-{:04d}.ndjson.{}'.format(output, slice_id, ext)
+        p = multiprocessing.Process(
+                target=_export_slice,
+                args=(slice_id, slices, index, query, source, fname,
+                      compression, progress))
+        p.start()
+        producers[slice_id] = p
+        fnames[slice_id] = fname
+
+    bar = SlowFancyBar('', max=N)
+    shards = []
+    running = set(producers)
+    start = time.time()
+
+    while running:
+        try:
+            n, shard = progress.get(True, 1)
+        except queue.Empty:
+            # producers killed before reporting (e.g., out of memory)
+            for slice_id in sorted(running):
+                p = producers[slice_id]
+                if not p.is_alive() and p.exitcode != 0:
+                    log.error('Slice %d/%d died (exit code %s)',
+                              slice_id, slices, p.exitcode)
+                    running.discard(slice_id)
+                    shards.append(dict(
+                        slice=slice_id,
+                        file=fnames[slice_id],
+                        docs=0,
+                        error='died (exit code {})'.format(p.exitcode)))
+            continue
+
+        if shard is not None:
+            running.discard(shard['slice'])
+            shards.append(shard)
+        bar.next(n)
+    bar.finish()
+
+    for p in producers.values():
+        p.join()
+
+    elapsed = time.time() - start
+    docs = sum(shard['docs'] for shard in shards)
+
+    manifest = dict(
+            index=index,
+            q=q,
+            fields=source,
+            compression=compression,
+            docs=docs,
+            bytes=sum(shard.get('bytes', 0) for shard in shards),
+            seconds=elapsed,
+            docs_per_second=docs / elapsed if elapsed else None,
+            shards=sorted(shards, key=lambda shard: shard['slice']))
+
+    simplejson.dump(manifest, sys.stdout, indent=2, sort_keys=True)
+    click.echo()
+
+    failed = [shard['slice'] for shard in shards if 'error' in shard]
+    if failed:
+        raise click.ClickException(
+                'Slices {} of {} failed: their shards are incomplete'.format(
+                    ', '.join(str(i) for i in sorted(failed)), slices))
+
+
+def _open_shard(fname, compression):
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(fname, 'wb'))
+
+    import gzip
+    return gzip.open(fname, 'wb', compresslevel=6)
+
+
+def _export_slice(slice_id, slices, index, query, source, fname,
+                  compression, progress):
+    """Producer process: write one scroll slice to its own shard"""
+    from defplorex.backend.encoder import dumps
+
+    # connections must not be shared with the parent process
+    _es = ES(settings)
+
+    shard = dict(slice=slice_id, file=fname, docs=0)
+    start = time.time()
+    n = 0
+
+    try:
+        with _open_shard(fname, compression) as f:
+            for hit in _es.scan(
+                    index,
+                    query,
+                    slice_id=slice_id,
+                    max_slices=slices,
+                    source=source):
+                f.write(dumps(dict(
+                    _id=hit['_id'], _source=hit.get('_source', {}))))
+                f.write(b'\n')
+
+                n += 1
+                if n == 1000:
+                    shard['docs'] += n
+                    progress.put((n, None))
+                    n = 0
+    except Exception as e:
+        log.error('Slice %d/%d failed: %s', slice_id, slices, e,
+                  exc_info=True)
+        shard['error'] = str(e)
+    finally:
+        shard['docs'] += n
+        shard['seconds'] = time.time() - start
+        if os.path.exists(fname):
+            shard['bytes'] = os.path.getsize(fname)
+        progress.put((n, shard))
+
+
+@features.command()
+@click.option(
+        '--index', '-i',
+        help='Read from index',
+        metavar='F', default=INDEX)
+@click.option(
+        '--feature', '-F',
+        multiple=True,
+        metavar='F', help='Numeric feature'
+        ' (default: setting "quantize.features")')
+@click.option(
+        '--percent', '-p',
+        multiple=True, type=float,
+        metavar='P', help='Percentile to use as threshold'
+        ' (default: setting "quantize.percents")')
+@click.option(
+        '--show', '-s',
+        is_flag=True, default=False, help='Only print the latest thresholds')
+@click.option(
+        '--from-sketches', '-S',
+        is_flag=True, default=False,
+        help='Merge the sketches of the workers instead of querying ES')
+@click.option(
+        '--reset-sketches',
+        is_flag=True, default=False,
+        help='Drop the sketches of the workers and exit')
+@click.argument('q', metavar='<q>', default='*')
+def thresholds(index, feature, percent, show, from_sketches, reset_sketches,
+               q):
+    """
+    Compute the percentile thresholds of the features and store them
+    """
+    from defplorex.quantize import ThresholdStore, percentiles
+    from defplorex.sketch import SketchStore
+
+    store = ThresholdStore.from_settings(settings)
+    sketches = SketchStore(
+            settings.get('sketch', {}).get('path', '~/.dpx-sketches'))
+
+    if reset_sketches:
+        sketches.reset()
+        return
+
+    if not show:
+        cfg = settings.get('quantize', {})
+        feature = list(feature) or cfg.get('features', [])
+        percent = list(percent) or cfg.get('percents', [25, 50, 75])
+
+        if from_sketches:
+            digests = sketches.merged()
+            t = dict(
+                    (f, [digests[f].percentile(p) for p in percent])
+                    for f in feature if f in digests and digests[f].count)
+            counts = dict((f, digests[f].count) for f in t)
+
+            store.save(t, source='sketches', counts=counts, percents=percent)
+        else:
+            t = percentiles(
+                    es.client,
+                    index=index,
+                    features=feature,
+                    percents=percent,
+                    q=q,
+                    doc_type=es.doc_type)
+
+            store.save(t, index=index, q=q, percents=percent)
+
+    simplejson.dump(store.load(), sys.stdout, indent=2, sort_keys=True)
+
+
+@features.command()
+@click.option(
+        '--index', '-i',
+        help='Read from index',
+        metavar='F', default=INDEX)
+@click.option(
+        '--feature', '-F',
+        multiple=True,
+        metavar='F', help='Numeric feature'
+        ' (default: setting "quantize.features")')
+@click.option(
+        '--binned', '-B',
+        multiple=True,
+        metavar='F', help='Binned feature, or full field name'
+        ' (default: the binned numeric features)')
+@click.option(
+        '--refresh', '-r',
+        is_flag=True, default=False, help='Append only the docs updated'
+        ' after the last export')
+@click.option(
+        '--reset',
+        is_flag=True, default=False, help='Drop the exported columns first')
+@click.option(
+        '--limit', '-l', type=int,
+        metavar='L', help='Limit number of records')
+@click.argument('q', metavar='<q>', default='*')
+def export(index, feature, binned, refresh, reset, limit, q):
+    """
+    Export the features to memory-mappable columns
+    """
+    from defplorex.cluster import binned_field
+    from defplorex.columnar import ColumnStore
+
+    store = ColumnStore.from_settings(settings)
+
+    if reset:
+        store.reset()
+
+    meta = store.meta()
+
+    if meta is not None and not refresh:
+        raise click.UsageError(
+                'Columns already exported to {}: use --refresh to append,'
+                ' or --reset to start over'.format(store.path))
+
+    cfg = settings.get('quantize', {})
+    labels = cfg.get('labels', [])
+
+    if meta is None:
+        feature = list(feature) or cfg.get('features', [])
+        binned = list(binned) or feature
+        binned = [binned_field(f, cfg.get('field', 'bins')) for f in binned]
+    else:
+        feature = [f for f, c in meta['columns'].items()
+                   if c['kind'] == 'numeric']
+        binned = [f for f, c in meta['columns'].items()
+                  if c['kind'] == 'binned']
+
+    query = dict(query_string=dict(query=q))
+
+    if meta is not None and meta['watermark']:
+        log.info('Exporting docs updated since %s', meta['watermark'])
+        query = dict(bool=dict(must=[
+            query,
+            dict(range=dict(last_updated=dict(gte=meta['watermark'])))]))
+
+    # `last_updated` is taken when a batch starts, before it is written,
+    # on the clock of the worker: keep a margin before this scan starts
+    margin = settings.get('columnar', {}).get('refresh_margin', 600)
+    watermark = (datetime.now() - timedelta(seconds=margin)).isoformat()
+
+    if limit:
+        # docs past the limit must still be exported by the next refresh
+        watermark = None
+
+    # the top-level objects are enough to reach the nested fields
+    source = sorted(set(f.split('.')[0] for f in feature + binned))
+
+    start = time.time()
+    n = store.append(
+            es.scan(
+                index,
+                dict(query=query),
+                limit=limit,
+                source=source),
+            numeric=feature,
+            binned=binned,
+            labels=labels,
+            watermark=watermark)
+
+    log.info('Exported %d docs in %.1fs', n, time.time() - start)
+
+
+@features.command()
+@click.option(
+        '--index', '-i',
+        help='Read from index',
+        metavar='F', default=INDEX)
+@click.option(
+        '--feature', '-F',
+        multiple=True,
+        metavar='F', help='Binned feature, or full field name'
+        ' (default: setting "quantize.features")')
+@click.option(
+        '--min-size', '-m', type=int, default=1,
+        metavar='N', help='Skip clusters smaller than N docs')
+@click.option(
+        '--page-size', '-P', type=int, default=1000,
+        metavar='N', help='Clusters per request')
+@click.option(
+        '--output', '-o',
+        type=click.File('w'), default=None,
+        metavar='FILE', help='Write NDJSON to FILE (\'-\' for stdout)'
+        ' instead of a table')
+@click.argument('q', metavar='<q>', default='*')
+def cluster(index, feature, min_size, page_size, output, q):
+    """
+    Group the documents by their binned features
+    """
+    from defplorex.cluster import binned_field, clusters
+
+    cfg = settings.get('quantize', {})
+    feature = list(feature) or cfg.get('features', [])
+    # aggregations need the keyword sub-fields of dynamically mapped bins
+    suffix = settings.get('cluster', {}).get('keyword_suffix', '.keyword')
+    fields = [
+            binned_field(f, cfg.get('field', 'bins'), suffix)
+            for f in feature]
+
+    if output is None:
+        click.echo('\t'.join(['docs'] + list(feature)))
+
+    n = docs = 0
+    for key, count in clusters(
+            es.client,
+            index=index,
+            fields=fields,
+            q=q,
+            size=page_size,
+            min_size=min_size,
+            doc_type=es.doc_type):
+        n += 1
+        docs += count
+
+        if output is None:
+            click.echo('\t'.join(
+                [str(count)] + [
+                    '-' if key.get(f) is None else str(key[f])
+                    for f in fields]))
+        else:
+            output.write(simplejson.dumps(dict(key=key, docs=count)))
+            output.write('\n')
+
+    log.info('%d clusters of at least %d docs (%d docs)', n, min_size, docs)
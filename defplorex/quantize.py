@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+from __future__ import division
+
+# built-in modules
+import os
+import re
+import glob
+import time
+import bisect
+import logging
+
+# 3rd party modules
+import simplejson
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+
+def percentiles(client, index, features, percents, q='*', doc_type=None):
+    """
+    Percentiles of each numeric feature over the docs matching `q`, in one
+    multi-aggregation request: {feature: [value per percent]}
+    """
+    body = dict(
+            size=0,
+            query=dict(query_string=dict(query=q)),
+            aggs=dict(
+                (f, dict(percentiles=dict(field=f, percents=percents)))
+                for f in features))
+
+    log.info('Computing percentiles %s of %d features', percents,
+             len(features))
+
+    res = client.search(index=index, doc_type=doc_type, body=body)
+
+    thresholds = {}
+    for f in features:
+        values = res['aggregations'][f]['values']
+        values = [v for _, v in sorted(
+            values.items(), key=lambda kv: float(kv[0]))]
+
+        if any(v is None for v in values):
+            log.warn('No values for feature %s, skipping', f)
+            continue
+
+        thresholds[f] = values
+
+    return thresholds
+
+
+class ThresholdStore(object):
+    """
+    Versioned thresholds, one JSON file per version in directory `path`
+    """
+    pattern = re.compile(r'thresholds-(\d+)\.json$')
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    @classmethod
+    def from_settings(cls, settings):
+        cfg = settings.get('quantize', {})
+        return cls(cfg.get('path', '~/.dpx-thresholds'))
+
+    def _fname(self, version):
+        return os.path.join(
+                self.path, 'thresholds-{:06d}.json'.format(version))
+
+    def versions(self):
+        versions = []
+        for fname in glob.glob(os.path.join(self.path, 'thresholds-*.json')):
+            m = self.pattern.search(fname)
+            if m:
+                versions.append(int(m.group(1)))
+        return sorted(versions)
+
+    def save(self, features, **meta):
+        """Store the thresholds of `features` as a new version"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        versions = self.versions()
+        version = versions[-1] + 1 if versions else 1
+
+        data = dict(meta)
+        data.update(**dict(
+            version=version,
+            created=time.time(),
+            features=features))
+
+        # write and rename, so that readers never see partial files
+        fname = self._fname(version)
+        with open(fname + '.tmp', 'w') as f:
+            simplejson.dump(data, f, indent=2, sort_keys=True)
+        os.rename(fname + '.tmp', fname)
+
+        log.info('Stored thresholds version %d in %s', version, fname)
+
+        return version
+
+    def load(self, version=None):
+        """Thresholds of `version` (default: latest), or `None`"""
+        if version is None:
+            versions = self.versions()
+            if not versions:
+                return None
+            version = versions[-1]
+
+        with open(self._fname(version)) as f:
+            return simplejson.load(f)
+
+
+class Quantizer(object):
+    """
+    Bin numeric values by thresholds: with thresholds t_1 < ... < t_n,
+    values up to t_1 get the first label, values in (t_i, t_i+1] get the
+    (i+1)-th one, values above t_n get the last one (i.e., outliers)
+    """
+    def __init__(self, features, labels):
+        self.features = features
+        self.labels = list(labels)
+
+        for f, thresholds in features.items():
+            if len(thresholds) + 1 != len(self.labels):
+                raise ValueError(
+                        'Feature {} has {} thresholds for {} labels'.format(
+                            f, len(thresholds), len(self.labels)))
+
+        if np is not None:
+            self._thresholds = dict(
+                    (f, np.asarray(t, dtype=float))
+                    for f, t in features.items())
+            self._labels = np.array(self.labels + [None], dtype=object)
+
+    def bin(self, feature, values):
+        """Labels of `values` (`None` for missing values)"""
+        thresholds = self.features[feature]
+
+        if np is None:
+            return [
+                    self.labels[bisect.bisect_left(thresholds, v)]
+                    if isinstance(v, (int, float)) else None
+                    for v in values]
+
+        x = np.array(
+                [v if isinstance(v, (int, float)) else np.nan
+                 for v in values],
+                dtype=float)
+
+        idx = np.searchsorted(self._thresholds[feature], x, side='left')
+        idx[np.isnan(x)] = len(self.labels)
+
+        return self._labels[idx].tolist()
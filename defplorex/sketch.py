@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+from __future__ import division
+
+# built-in modules
+import os
+import glob
+import math
+import time
+import uuid
+import socket
+import logging
+import threading
+
+# 3rd party modules
+import simplejson
+
+log = logging.getLogger(__name__)
+
+
+class TDigest(object):
+    """
+    Mergeable quantile sketch (merging t-digest): values are summarized by
+    at most ~`compression` centroids, small at the tails for accuracy
+    there, so memory stays bounded however many values are added.
+    """
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.centroids = []
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._buffer = []
+
+    def _k(self, q):
+        # arcsine scale function: centroids shrink towards the tails
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def add(self, x, w=1):
+        x = float(x)
+
+        self._buffer.append((x, w))
+        self.count += w
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+
+        if len(self._buffer) >= 5 * self.compression:
+            self._compress()
+
+    def update(self, values):
+        for x in values:
+            self.add(x)
+
+    def merge(self, other):
+        """Add the values summarized by another digest"""
+        if not other.count:
+            return
+
+        self._buffer.extend(tuple(c) for c in other.centroids)
+        self._buffer.extend(other._buffer)
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+        self._compress()
+
+    def _compress(self):
+        if not self._buffer:
+            return
+
+        items = sorted(self.centroids + self._buffer)
+        self._buffer = []
+
+        total = self.count
+        merged = []
+        left = 0
+        mean, weight = items[0]
+
+        for x, w in items[1:]:
+            q_left = left / total
+            q_right = (left + weight + w) / total
+
+            if self._k(q_right) - self._k(q_left) <= 1:
+                mean = (mean * weight + x * w) / (weight + w)
+                weight += w
+            else:
+                merged.append((mean, weight))
+                left += weight
+                mean, weight = x, w
+
+        merged.append((mean, weight))
+        self.centroids = merged
+
+    def quantile(self, q):
+        """Estimated value at quantile `q` (0-1), `None` if empty"""
+        self._compress()
+
+        if not self.centroids:
+            return None
+
+        target = q * self.count
+
+        # interpolate between centroid centers, and min/max at the edges
+        points = [(0.0, self.min)]
+        cum = 0
+        for mean, w in self.centroids:
+            points.append((cum + w / 2, mean))
+            cum += w
+        points.append((float(self.count), self.max))
+
+        for (c0, m0), (c1, m1) in zip(points, points[1:]):
+            if target <= c1:
+                if c1 == c0:
+                    return m1
+                return m0 + (m1 - m0) * (target - c0) / (c1 - c0)
+
+        return self.max
+
+    def percentile(self, p):
+        return self.quantile(p / 100)
+
+    def to_dict(self):
+        self._compress()
+        return dict(
+                compression=self.compression,
+                count=self.count,
+                min=self.min,
+                max=self.max,
+                centroids=self.centroids)
+
+    @classmethod
+    def from_dict(cls, data):
+        d = cls(data['compression'])
+        d.count = data['count']
+        d.min = data['min']
+        d.max = data['max']
+        d.centroids = [tuple(c) for c in data['centroids']]
+        return d
+
+
+class SketchStore(object):
+    """
+    Directory of per-process sketch files: each worker process overwrites
+    its own file, readers merge all of them
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def save(self, name, digests):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        fname = os.path.join(self.path, 'sketch-{}.json'.format(name))
+        data = dict((f, d.to_dict()) for f, d in digests.items())
+
+        # write and rename, so that readers never see partial files
+        with open(fname + '.tmp', 'w') as f:
+            simplejson.dump(data, f)
+        os.rename(fname + '.tmp', fname)
+
+    def merged(self):
+        """All stored sketches, merged: {feature: TDigest}"""
+        digests = {}
+
+        for fname in glob.glob(os.path.join(self.path, 'sketch-*.json')):
+            with open(fname) as f:
+                data = simplejson.load(f)
+
+            for feature, d in data.items():
+                d = TDigest.from_dict(d)
+                if feature in digests:
+                    digests[feature].merge(d)
+                else:
+                    digests[feature] = d
+
+        return digests
+
+    def reset(self):
+        for fname in glob.glob(os.path.join(self.path, 'sketch-*.json')):
+            os.remove(fname)
+
+
+class FeatureSketches(object):
+    """
+    Sketches of the numeric features seen by a worker process, flushed to
+    a `SketchStore` so that thresholds can be computed without querying
+    the whole index
+    """
+    def __init__(self, features, store, compression=100, flush_interval=10):
+        self.features = list(features)
+        self.store = store
+        self.flush_interval = flush_interval
+        # PIDs are reused: a new process must not overwrite a dead one's
+        self.name = '{}-{}'.format(socket.gethostname(), uuid.uuid4().hex)
+        self.digests = dict(
+                (f, TDigest(compression)) for f in self.features)
+
+        self._flushed = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Return sketches if enabled in `settings`, `None` otherwise"""
+        cfg = settings.get('sketch', {})
+
+        if not cfg.get('enabled', False):
+            return None
+
+        features = cfg.get('features') or \
+            settings.get('quantize', {}).get('features', [])
+
+        return cls(
+                features,
+                SketchStore(cfg.get('path', '~/.dpx-sketches')),
+                compression=cfg.get('compression', 100),
+                flush_interval=cfg.get('flush_interval', 10))
+
+    def observe(self, docs):
+        """Add the numeric feature values of `docs` (mappings)"""
+        with self._lock:
+            for doc in docs:
+                for f in self.features:
+                    v = doc.get(f)
+                    if isinstance(v, (int, float)) and \
+                            not isinstance(v, bool):
+                        self.digests[f].add(v)
+
+    def flush(self, force=False):
+        """Save the sketches, at most once every `flush_interval` seconds"""
+        with self._lock:
+            if not force and \
+                    time.time() - self._flushed < self.flush_interval:
+                return
+            self.store.save(self.name, self.digests)
+            self._flushed = time.time()
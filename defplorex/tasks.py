@@ -32,7 +32,11 @@ import logging
 
 from celeryapp import app as clapp
 
+from defplorex.backend.elastic import FailedDocsException
 from defplorex.transformer import TagTransformer, TransformerFactory, Pipeline
+from defplorex.transformer.view import DocView
+from defplorex.transformer.dag import TransformerDAG
+from defplorex.worker import registry
 
 log = logging.getLogger(__name__)
 
@@ -41,55 +45,144 @@ class ProcessorTask(object):
     max_retries = 3
     default_retry_delay = 30
 
-    _settings = None
-    _es = None
-
     @property
     def settings(self):
-        if self._settings is None:
-            from config import load_settings
-            self._settings = load_settings()
-        return self._settings
+        return registry.settings
 
     @property
     def es(self):
-        if self._es is None:
-            from defplorex.backend.elastic import ES
-            self._es = ES(self.settings)
-        return self._es
+        return registry.es
 
     def __init__(self, transformers, tr_args=[], tr_kwargs={}):
-        self.transformers = [TagTransformer()]
+        # instances live in the worker registry and are shared by tasks
+        self.transformers = [registry.transformer(TagTransformer)]
+
+        # stamped with their version even when they have nothing to update
+        self.requested = []
 
         if isinstance(transformers, list):
+            self.requested = [k._name for k in transformers]
             for k in transformers:
-                tr_kwargs.update(**dict(settings=self.settings))
-                self.transformers.append(k(*tr_args, **tr_kwargs))
+                self.transformers.append(
+                        registry.transformer(k, tr_args, tr_kwargs))
+
+        # independent transformers run concurrently
+        self.dag = TransformerDAG(
+                self.transformers,
+                threads=self.settings.get('dag', {}).get('threads', 1))
 
     def run(self, ids, index, *args, **kwargs):
-        log.info('Received task for %d IDs on index %s', len(ids), index)
+        docs = kwargs.pop('docs', None) or []
+
+        log.info(
+                'Received task for %d IDs and %d inline docs on index %s',
+                len(ids), len(docs), index)
 
         query = dict(query=dict(ids=dict(values=filter(lambda x: x, ids))))
         kwargs.update(**dict(settings=self.settings))
         update = kwargs.get('update', True)
         ephemeral = kwargs.get('ephemeral', False)
 
-        def _transform(doc):
-            return Pipeline.chain(
-                    doc,
-                    self.transformers,
-                    updates_only=update, *args, **kwargs)
+        cache = registry.cache
+        if cache is not None:
+            cache.reset_stats()
+
+        # ephemeral results are not stored: keep them out of the sketches
+        sketches = None if ephemeral else registry.sketches
+
+        # fetch only what the transformers read, unless re-indexing
+        source = None
+        if update:
+            source = Pipeline.source_fields(self.transformers)
+            if source is not None and sketches is not None:
+                source = sorted(set(source or []) | set(sketches.features))
+            log.debug('Fetching _source fields: %s', source)
+
+        # every fetched page goes through the transformers at once
+        def _transform(page):
+            res = Pipeline.chain_batch(
+                    page,
+                    self.dag,
+                    updates_only=update,
+                    cache=cache,
+                    requested=self.requested, *args, **kwargs)
+
+            # features as they will be stored: original + updates
+            if sketches is not None:
+                for d, r in zip(page, res):
+                    if isinstance(r, Exception):
+                        continue
+
+                    original = Pipeline._original(d)
+
+                    # unchanged docs are not written
+                    if update and not self.es.changes(original, r or {}):
+                        continue
+
+                    doc = DocView(original, r or {})
+                    written[d.get('_id')] = dict(
+                            (f, doc.get(f)) for f in sketches.features)
+            return res
 
         if ephemeral:
-            return [_transform(doc) for doc in self.es.scan(index, query)]
+            page = list(docs)
+            if ids:
+                page.extend(self.es.scan(index, query, source=source))
+
+            res = _transform(page)
+            for r in res:
+                if isinstance(r, Exception):
+                    raise r
+            return res
+
+        failures = {}
+
+        # features of the docs to write, observed once they are written
+        written = {}
+
+        # inline docs are already here: do not read them again
+        if docs:
+            failures.update(self.es.partial_update_from_docs(
+                index=index,
+                docs=docs,
+                transform=_transform,
+                batch=True,
+                skip_unchanged=update))
 
-        err_ids = self.es.partial_update_from_query(
+        if ids:
+            failures.update(self.es.partial_update_from_query(
                 index=index,
                 query=query,
-                transform=_transform)
+                transform=_transform,
+                source=source,
+                batch=True,
+                skip_unchanged=update))
+
+        log.info(
+                'Processed %d docs on index %s: %d failed',
+                len(ids) + len(docs), index, len(failures))
+
+        if cache is not None:
+            log.info(
+                    'Transformer cache hit rate: %.1f%% (%s)',
+                    100 * cache.hit_rate, cache.stats)
+
+        log.info('Transformer wall times: %s', self.dag.report())
 
-        if err_ids:
-            raise Exception('IDs = %s have failed (will retry)', err_ids)
+        # failed docs will be retried: observe them then
+        if sketches is not None:
+            sketches.observe(
+                    features for _id, features in written.items()
+                    if _id not in failures)
+            sketches.flush()
+
+        if failures:
+            raise FailedDocsException(failures)
+
+    @classmethod
+    def backoff(cls, retries):
+        """Exponential retry delay, in seconds"""
+        return cls.default_retry_delay * 2 ** retries
 
 
 @clapp.task(
@@ -99,6 +192,9 @@ class ProcessorTask(object):
 def processor_task(self, ids, index, **kwargs):
     """
     Generic task that executes a serie of transformations on the doc
+
+    Documents are read from `index` by ID, unless they are shipped inline
+    as `docs` (a list of `{'_id', '_source'}` hits).
     """
     transformers_lst = kwargs.get('transformers_lst', [])
     tr_args = kwargs.get('tr_args', [])
@@ -114,10 +210,35 @@ def processor_task(self, ids, index, **kwargs):
             tr_args=tr_args,
             tr_kwargs=tr_kwargs)
 
+    countdown = ProcessorTask.backoff(self.request.retries)
+
     try:
         r = processor.run(ids, index, **kwargs)
         if ephemeral:
             return r
+    except FailedDocsException as e:
+        permanent = e.permanent_ids
+        transient = set(e.transient_ids)
+
+        if permanent:
+            log.error(
+                    'Task %s: giving up on %d docs (permanent errors): %s',
+                    self.request.id, len(permanent), permanent)
+
+        if not transient:
+            return
+
+        # retry on the failed docs only
+        ids = [_id for _id in ids if _id in transient]
+        kwargs['docs'] = [
+                d for d in kwargs.get('docs') or []
+                if d.get('_id') in transient]
+
+        log.warn(
+                'Retrying task %s on %d failed docs in %ds',
+                self.request.id, len(transient), countdown)
+        raise self.retry(
+                args=(ids, index), kwargs=kwargs, exc=e, countdown=countdown)
     except Exception as e:
         log.warn('Retrying task %s because: %s', self.request.id, e)
-        raise self.retry(exc=e)
+        raise self.retry(exc=e, countdown=countdown)
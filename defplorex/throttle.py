@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+from __future__ import division
+
+# built-in modules
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class QueueThrottle(object):
+    """
+    Backpressure on the broker queue of a Celery task: `wait()` blocks
+    while more than `high` messages are pending, until they drop to `low`,
+    so that producers do not outrun the workers.
+    """
+    def __init__(self, app, queue='processor_task', high=1000, low=None,
+                 interval=5):
+        self.app = app
+        self.queue = queue
+        self.high = high
+        self.low = high // 2 if low is None else low
+        self.interval = interval
+
+        self.tasks = 0
+        self.docs = 0
+        self.paused = 0
+        self.pending = None
+        self.drain_rate = None
+
+        self._start = time.time()
+        self._sample = None
+        self._conn = None
+
+    @classmethod
+    def from_settings(cls, app, settings):
+        """Return a throttle if enabled in `settings`, `None` otherwise"""
+        cfg = settings.get('enqueue', {}).get('throttle', {})
+
+        if not cfg.get('enabled', True):
+            return None
+
+        return cls(
+                app,
+                queue=cfg.get('queue', 'processor_task'),
+                high=cfg.get('high_watermark', 1000),
+                low=cfg.get('low_watermark'),
+                interval=cfg.get('interval', 5))
+
+    def depth(self):
+        """Number of messages waiting in the queue"""
+        try:
+            if self._conn is None:
+                self._conn = self.app.connection_for_write()
+
+            ok = self._conn.default_channel.queue_declare(
+                    queue=self.queue, passive=True)
+            depth = ok.message_count
+        except Exception as e:
+            # e.g., Redis drops the list of an empty queue
+            log.debug('Cannot read the depth of queue %s: %s', self.queue, e)
+            if self._conn is not None:
+                self._conn.release()
+                self._conn = None
+            depth = 0
+
+        # pending before + enqueued since - pending now = drained
+        now = time.time()
+        if self._sample is not None:
+            t, pending, tasks = self._sample
+            if now > t:
+                drained = pending + self.tasks - tasks - depth
+                self.drain_rate = max(drained, 0) / (now - t)
+        self._sample = (now, depth, self.tasks)
+
+        self.pending = depth
+        return depth
+
+    def record(self, docs):
+        """Account for one task of `docs` documents just enqueued"""
+        self.tasks += 1
+        self.docs += docs
+
+    def wait(self, keep_alive=None, timeout=None):
+        """
+        Block while the queue is above the high watermark, calling
+        `keep_alive` (e.g., to keep a search context open) in the
+        meantime, or for `timeout` seconds at most (e.g., as some search
+        contexts cannot be kept alive); return the seconds spent waiting
+        """
+        if self.depth() <= self.high:
+            return 0
+
+        log.info('%d tasks pending on queue %s, pausing until %d',
+                 self.pending, self.queue, self.low)
+
+        start = time.time()
+        while self.depth() > self.low:
+            if timeout is not None and time.time() - start >= timeout:
+                log.warn('Resuming after %.0fs with %d tasks pending,'
+                         ' not to lose the search context',
+                         time.time() - start, self.pending)
+                break
+            time.sleep(self.interval)
+            if keep_alive is not None:
+                keep_alive()
+
+        paused = time.time() - start
+        self.paused += paused
+
+        log.info('Resuming after %.0fs (%d tasks pending)',
+                 paused, self.pending)
+
+        return paused
+
+    @property
+    def enqueue_rate(self):
+        """Documents enqueued per second of activity"""
+        elapsed = time.time() - self._start - self.paused
+        return self.docs / elapsed if elapsed > 0 else 0
+
+    def status(self):
+        return 'pending {} tasks, enqueued {:.0f} docs/s,' \
+               ' drained {} tasks/s, paused {:.0f}s'.format(
+                   '?' if self.pending is None else self.pending,
+                   self.enqueue_rate,
+                   '?' if self.drain_rate is None else
+                   '{:.1f}'.format(self.drain_rate),
+                   self.paused)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.release()
+            self._conn = None
@@ -28,18 +28,29 @@
 # those of the authors and should not be interpreted as representing official
 # policies, either expressed or implied, of the FreeBSD Project.
 
+import hashlib
 import logging
 
+import simplejson
+
 from defplorex.transformer.tag import TagTransformer
+from defplorex.transformer.quantize import QuantizeTransformer
+from defplorex.transformer.view import DocView, thaw
+from defplorex.transformer.dag import TransformerDAG
 
 log = logging.getLogger(__name__)
 
+# {transformer name: version} of the transformers that processed a doc
+VERSIONS_FIELD = '_dpx_versions'
+
 __all__ = [
-    'TagTransformer'
+    'TagTransformer',
+    'QuantizeTransformer'
 ]
 
 classes = [
-    TagTransformer
+    TagTransformer,
+    QuantizeTransformer
 ]
 
 
@@ -65,22 +76,205 @@ class TransformerFactory(object):
 
 class Pipeline(object):
     @staticmethod
-    def chain(doc, transformers, updates_only=True, *args, **kwargs):
-        doc = doc.copy()
+    def source_fields(transformers):
+        """
+        Fields that `transformers` (classes or instances) read, to filter
+        the `_source` of the docs to fetch: `None` (i.e., the whole
+        `_source`) unless each of them declares its `_fields`
+        """
+        fields = set()
+
+        for transformer in transformers:
+            if transformer._fields is None:
+                return None
+            fields.update(transformer._fields)
+
+        # the versions are compared to decide whether the doc changed
+        fields.add(VERSIONS_FIELD)
 
+        return sorted(fields)
+
+    @staticmethod
+    def version_stamp(transformer, kwargs):
+        """
+        (key, `_version`) stamp of `transformer`: the key is its name, plus
+        a digest of the keyword arguments (`_params`) that it reads, so
+        that a doc keeps one stamp per set of arguments (e.g., per tag)
+        """
+        if not transformer._params:
+            return transformer._name, transformer._version
+
+        params = dict((p, kwargs.get(p)) for p in transformer._params)
+        digest = hashlib.sha1(simplejson.dumps(
+            params, sort_keys=True, default=str).encode('utf-8'))
+
+        return '{}-{}'.format(
+                transformer._name, digest.hexdigest()[:8]), \
+            transformer._version
+
+    @staticmethod
+    def versions(transformers, kwargs):
+        """{name: (key, version)} stamps of the versioned `transformers`"""
+        return dict(
+                (t._name, Pipeline.version_stamp(t, kwargs))
+                for t in transformers if t._version is not None)
+
+    @staticmethod
+    def _stamps(versions, transformers, overlays, requested):
+        # a transformer processed the doc if it was asked to, or if it
+        # had something to say: e.g., the tag transformer without a tag
+        # runs on every doc, but it did not tag it
+        return dict(
+                versions[t._name]
+                for t, updates in zip(transformers, overlays)
+                if t._name in versions and
+                (updates or t._name in requested))
+
+    @staticmethod
+    def stale_query(transformers, kwargs):
+        """
+        Query string matching the docs that miss the current version of
+        any of `transformers` (instances), called with `kwargs`; `None` if
+        none is versioned
+        """
+        versions = Pipeline.versions(transformers, kwargs)
+        if not versions:
+            return None
+
+        return 'NOT ({})'.format(' AND '.join(
+            '{}.{}:"{}"'.format(VERSIONS_FIELD, key, version)
+            for key, version in sorted(versions.values())))
+
+    @staticmethod
+    def _original(doc):
         if '_source' in doc:
-            doc = doc.get('_source', {})
+            return doc.get('_source', {})
+        return doc
 
-        kwargs.update(**dict(original_doc=doc))
-        updates = {}
+    @staticmethod
+    def _result(original, overlays, updates_only, versions=None):
+        # the only merge: the updates of each transformer, in order
+        updates = DocView(*overlays).merged()
 
-        for transformer in transformers:
-            _ = transformer(updates.copy(), *args, **kwargs)
-            updates.update(**_)
+        # stamp the versions next to those of earlier runs
+        if versions:
+            stamps = dict(original.get(VERSIONS_FIELD) or {})
+            stamps.update(versions)
+            updates[VERSIONS_FIELD] = stamps
 
         if updates_only:
             return updates
 
-        doc.update(**updates)
+        doc = dict(original)
+        doc.update(updates)
 
         return doc
+
+    @staticmethod
+    def chain(doc, transformers, updates_only=True, *args, **kwargs):
+        """
+        Apply `transformers` in order; with a `TransformerCache` as `cache`
+        keyword argument, cacheable transformers go through it.
+
+        Each transformer receives a read-only view of the updates so far,
+        and of the original document as `original_doc`; its own updates
+        are stacked on top, and flattened only once at the end.
+
+        The versions of the transformers named in `requested`, and of
+        those that returned updates, are stamped in `VERSIONS_FIELD`.
+        """
+        cache = kwargs.pop('cache', None)
+        requested = kwargs.pop('requested', ())
+        original = Pipeline._original(doc)
+
+        kwargs.update(**dict(original_doc=DocView(original)))
+        overlays = []
+
+        for transformer in transformers:
+            updates = DocView(*overlays)
+            if cache is not None:
+                _ = cache(transformer, updates, *args, **kwargs)
+            else:
+                _ = transformer(updates, *args, **kwargs)
+            overlays.append(thaw(_))
+
+        stamps = Pipeline._stamps(
+                Pipeline.versions(transformers, kwargs),
+                transformers,
+                overlays,
+                requested)
+
+        return Pipeline._result(original, overlays, updates_only, stamps)
+
+    @staticmethod
+    def chain_batch(docs, transformers, updates_only=True, *args, **kwargs):
+        """
+        Like `chain`, on a page of docs: each transformer sees the whole
+        page via `transform_batch`. Return one result per doc, or the
+        exception that made it fail (later transformers skip it).
+
+        `transformers` can be a `TransformerDAG`, to run the independent
+        transformers concurrently: each one sees only the updates of the
+        transformers it depends on.
+        """
+        cache = kwargs.pop('cache', None)
+        requested = kwargs.pop('requested', ())
+
+        dag = transformers
+        if not isinstance(dag, TransformerDAG):
+            dag = TransformerDAG(transformers)
+
+        originals = [Pipeline._original(doc) for doc in docs]
+        views = [DocView(original) for original in originals]
+
+        # updates of each doc, per transformer
+        overlays = [[None] * len(originals) for _ in dag.transformers]
+        failed = {}
+
+        def run(node):
+            transformer = dag.transformers[node]
+            live = [i for i in range(len(originals)) if i not in failed]
+            if not live:
+                return
+
+            _docs = [
+                    DocView(*[
+                        overlays[a][i] for a in dag.ancestors[node]
+                        if overlays[a][i] is not None])
+                    for i in live]
+            _originals = [views[i] for i in live]
+
+            if cache is not None:
+                res = cache.call_batch(
+                        transformer, _docs, _originals, *args, **kwargs)
+            else:
+                res = transformer.transform_batch(
+                        _docs, _originals, *args, **kwargs)
+
+            for i, _ in zip(live, res):
+                if isinstance(_, Exception):
+                    failed[i] = _
+                else:
+                    overlays[node][i] = thaw(_)
+
+        dag.run(run)
+
+        versions = Pipeline.versions(dag.transformers, kwargs)
+        results = []
+        for i, original in enumerate(originals):
+            if i in failed:
+                results.append(failed[i])
+            else:
+                results.append(Pipeline._result(
+                    original,
+                    [overlays[node][i] for node in dag.order
+                        if overlays[node][i] is not None],
+                    updates_only,
+                    Pipeline._stamps(
+                        versions,
+                        dag.transformers,
+                        [overlays[node][i]
+                            for node in range(len(dag.transformers))],
+                        requested)))
+
+        return results
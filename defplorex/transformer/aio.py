@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+# NOTE Python 3 only: import this module explicitly where needed
+
+# built-in modules
+import asyncio
+import logging
+import threading
+
+# local modules
+from defplorex.transformer.base import Transformer
+
+log = logging.getLogger(__name__)
+
+
+class EventLoopThread(object):
+    """
+    Event loop running forever in a daemon thread: one per worker process,
+    shared by all its tasks (see `worker.registry.event_loop`).
+
+    Its semaphores cap the calls in flight across all those tasks: at most
+    `concurrency` overall, plus any per-transformer cap.
+    """
+    def __init__(self, concurrency=100):
+        self.concurrency = concurrency
+        self._semaphores = {}
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+                target=self._run,
+                name='dpx-asyncio')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def semaphore(self, key=None, value=None):
+        """
+        Semaphore `key` (`None` for the global one), created on first use;
+        to be called from coroutines running on the loop
+        """
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(
+                    self.concurrency if key is None else value)
+        return self._semaphores[key]
+
+    def run(self, coro):
+        """Run `coro` on the loop, from any thread, and wait for it"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class AsyncTransformer(Transformer):
+    """
+    Transformer for network-bound work: subclasses implement `acall`, a
+    coroutine with the same contract as `Transformer.__call__`.
+
+    A page of documents is transformed concurrently on the worker's event
+    loop. At most `async.concurrency` calls (see settings) are in flight
+    per worker process, whatever the tasks and transformers running; set
+    `_concurrency` to cap the calls of a transformer further.
+    """
+    _concurrency = None
+
+    async def acall(self, doc, *args, **kwargs):
+        raise NotImplementedError
+
+    @staticmethod
+    def _loop():
+        from defplorex.worker import registry
+        return registry.event_loop
+
+    def __call__(self, doc, *args, **kwargs):
+        return self._loop().run(self.acall(doc, *args, **kwargs))
+
+    def transform_batch(self, docs, originals, *args, **kwargs):
+        return self._loop().run(self._gather(docs, originals, args, kwargs))
+
+    async def _gather(self, docs, originals, args, kwargs):
+        loop = self._loop()
+        semaphore = loop.semaphore()
+        own = None
+        if self._concurrency:
+            own = loop.semaphore(self._name, self._concurrency)
+
+        async def call(doc, original_doc):
+            async with semaphore:
+                try:
+                    return await self.acall(
+                            doc, *args, original_doc=original_doc, **kwargs)
+                except Exception as e:
+                    log.warn('%s failed on a doc: %s', self._name, e)
+                    return e
+
+        async def capped(doc, original_doc):
+            # take the per-transformer slot first, not to hold a global one
+            # while waiting for it
+            async with own:
+                return await call(doc, original_doc)
+
+        log.debug(
+                'Running %s on %d docs (concurrency = %d per worker, %s)',
+                self._name, len(docs), loop.concurrency,
+                self._concurrency or 'no cap of its own')
+
+        return await asyncio.gather(*[
+            (capped if own else call)(doc, original_doc)
+            for doc, original_doc in zip(docs, originals)])
@@ -36,8 +36,89 @@ log = logging.getLogger(__name__)
 class Transformer(object):
     """
     Generic class to transform documents
+
+    Transforms receive read-only views (see `transformer.view`) of the
+    updates so far and of the original document (`original_doc`), and
+    return their own updates as a dict.
+
+    Subclasses can declare:
+
+      * `_version`: bumped whenever the output for a given input changes;
+      * `_fields`: the document fields that the transform reads;
+      * `_params`: the keyword arguments that the transform reads;
+      * `_provides`: the fields that the transform returns;
+      * `_requires`: the fields, returned by other transforms, that the
+        transform reads;
+      * `_cpu_bound`: whether pages should be fanned out to the worker's
+        process pool (see `transformer.pool`).
+
+    Declaring the first three makes the results cacheable (see
+    `transformer.cache`); declaring the next two lets the transform run
+    concurrently with the independent ones (see `transformer.dag`).
     """
+    _version = None
+    _fields = None
+    _params = ()
+    _provides = None
+    _requires = ()
+    _cpu_bound = False
+
+    def __init__(self, *args, **kwargs):
+        self.settings = kwargs.get('settings', {})
+
+    def outdated(self):
+        """
+        Whether the data that this instance loaded upfront (e.g., a model)
+        has a newer version, so that long-lived workers build a new one
+        """
+        return False
+
+    def __getstate__(self):
+        # do not ship the settings to the process pool
+        state = self.__dict__.copy()
+        state.pop('settings', None)
+        return state
+
+    def __setstate__(self, state):
+        from defplorex.worker import registry
+
+        self.__dict__.update(state)
+        self.settings = registry.settings
+
     def __call__(self, doc, *args, **kwargs):
         log.info('Calling %s', self._name)
         return kwargs.get('original_doc', {})
 
+    def transform_batch(self, docs, originals, *args, **kwargs):
+        """
+        Transform a page of documents at once: `docs[i]` holds the updates
+        so far on `originals[i]`. Return one result per document, or the
+        exception raised on it.
+
+        Override to amortize setup or to vectorize over the page; by
+        default, the transform is called on each document, in the worker's
+        process pool if `_cpu_bound`.
+        """
+        if self._cpu_bound:
+            from defplorex.worker import registry
+
+            pool = registry.process_pool
+            if pool is not None:
+                return pool.transform_batch(
+                        self, docs, originals, *args, **kwargs)
+
+        return self._transform_each(docs, originals, *args, **kwargs)
+
+    def _transform_each(self, docs, originals, *args, **kwargs):
+        res = []
+
+        for doc, original_doc in zip(docs, originals):
+            kwargs.update(**dict(original_doc=original_doc))
+            try:
+                res.append(self(doc, *args, **kwargs))
+            except Exception as e:
+                log.warn('%s failed on a doc: %s', self._name, e)
+                res.append(e)
+
+        return res
+
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+from __future__ import division
+
+# built-in modules
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# 3rd party modules
+import simplejson
+
+# local modules
+from defplorex.backend.encoder import dumps
+from defplorex.transformer.view import thaw
+
+log = logging.getLogger(__name__)
+
+_MISS = object()
+
+
+class TransformerCache(object):
+    """
+    On-disk cache of transformer results.
+
+    Entries are addressed by transformer name and `_version`, and by a hash
+    of the fields (`_fields`, and `_requires` from upstream transformers)
+    and keyword arguments (`_params`) that the transformer reads, so any
+    change in the input is a miss. Transformers
+    that do not declare all of these are never cached. The store is a
+    SQLite file, shared by the worker processes of the host; the least
+    recently used entries are evicted beyond `max_bytes`. Pages are read
+    and written in one query and one transaction each; the access times of
+    hits are written along with the next write.
+    """
+    # SQLite allows 999 parameters per query, by default
+    max_params = 500
+
+    # hits whose access time is not written yet
+    max_touched = 10000
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False)
+        self._db.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                ' key TEXT PRIMARY KEY,'
+                ' value BLOB,'
+                ' size INTEGER,'
+                ' atime REAL)')
+        self._db.execute(
+                'CREATE INDEX IF NOT EXISTS cache_atime ON cache (atime)')
+        self._db.commit()
+
+        self._size = self._total_size()
+        self._touched = {}
+
+        self.reset_stats()
+
+        log.info(
+                'Transformer cache at %s (%d/%d bytes)',
+                self.path, self._size, self.max_bytes)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Return a cache if enabled in `settings`, `None` otherwise"""
+        cfg = settings.get('cache', {})
+
+        if not cfg.get('enabled', False):
+            return None
+
+        return cls(
+                path=cfg.get('path', 'dpx-cache.sqlite'),
+                max_bytes=cfg.get('max_bytes', 1024 * 1024 * 1024))
+
+    @staticmethod
+    def cacheable(transformer):
+        return transformer._version is not None and \
+                transformer._fields is not None
+
+    def _total_size(self):
+        row = self._db.execute('SELECT SUM(size) FROM cache').fetchone()
+        return row[0] or 0
+
+    def key(self, transformer, doc, original_doc, kwargs):
+        """Content address of a transformer call"""
+        # the fields returned by upstream transformers are inputs too
+        fields = set(transformer._fields) | set(transformer._requires)
+        inputs = dict(
+                fields=dict(
+                    (f, thaw(doc.get(f, original_doc.get(f))))
+                    for f in fields),
+                params=dict((p, kwargs.get(p)) for p in transformer._params))
+
+        digest = hashlib.sha1(simplejson.dumps(
+            inputs, sort_keys=True, default=str).encode('utf-8'))
+
+        return '{}:{}:{}'.format(
+                transformer._name, transformer._version, digest.hexdigest())
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        """Cached values of `keys` (`_MISS` if absent), in one read"""
+        found = {}
+
+        with self._lock:
+            # stay below the SQLite limit on query parameters
+            for i in range(0, len(keys), self.max_params):
+                batch = list(set(keys[i:i + self.max_params]))
+                rows = self._db.execute(
+                        'SELECT key, value FROM cache WHERE key IN ({})'
+                        .format(', '.join('?' * len(batch))), batch)
+                found.update(rows)
+
+            # access times are written along with the next write
+            now = time.time()
+            for key in found:
+                self._touched[key] = now
+
+            self.stats['hits'] += sum(1 for key in keys if key in found)
+            self.stats['misses'] += sum(1 for key in keys if key not in found)
+
+            if len(self._touched) >= self.max_touched:
+                self._flush_touched()
+                self._db.commit()
+
+        return [
+                simplejson.loads(bytes(found[key]).decode('utf-8'))
+                if key in found else _MISS
+                for key in keys]
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        """Store the (key, value) pairs of `items`, in one transaction"""
+        now = time.time()
+        rows = []
+        for key, value in items:
+            value = dumps(value)
+            rows.append((key, sqlite3.Binary(value), len(value), now))
+
+        with self._lock:
+            self._db.executemany(
+                    'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', rows)
+            self._flush_touched()
+            self._db.commit()
+            self._size += sum(row[2] for row in rows)
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _flush_touched(self):
+        self._db.executemany(
+                'UPDATE cache SET atime = ? WHERE key = ?',
+                [(t, key) for key, t in self._touched.items()])
+        self._touched = {}
+
+    def _evict(self):
+        # other processes write too: start from the actual size
+        self._flush_touched()
+        self._size = self._total_size()
+        target = self.max_bytes * 0.9
+
+        rows = self._db.execute('SELECT key, size FROM cache ORDER BY atime')
+
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+
+        self._db.executemany('DELETE FROM cache WHERE key = ?', evicted)
+        self._db.commit()
+
+        self.stats['evicted'] += len(evicted)
+        log.info('Evicted %d cache entries', len(evicted))
+
+    def __call__(self, transformer, doc, *args, **kwargs):
+        """Call `transformer` on `doc`, through the cache if possible"""
+        if not self.cacheable(transformer):
+            return transformer(doc, *args, **kwargs)
+
+        key = self.key(
+                transformer, doc, kwargs.get('original_doc', {}), kwargs)
+
+        res = self.get(key)
+        if res is _MISS:
+            res = thaw(transformer(doc, *args, **kwargs))
+            self.put(key, res)
+
+        return res
+
+    def call_batch(self, transformer, docs, originals, *args, **kwargs):
+        """Like `__call__`, on a page: only the misses are transformed"""
+        if not self.cacheable(transformer):
+            return transformer.transform_batch(
+                    docs, originals, *args, **kwargs)
+
+        keys = [
+                self.key(transformer, doc, original_doc, kwargs)
+                for doc, original_doc in zip(docs, originals)]
+        res = self.get_many(keys)
+
+        misses = [i for i, r in enumerate(res) if r is _MISS]
+
+        if misses:
+            computed = transformer.transform_batch(
+                    [docs[i] for i in misses],
+                    [originals[i] for i in misses],
+                    *args, **kwargs)
+
+            items = []
+            for i, r in zip(misses, computed):
+                if not isinstance(r, Exception):
+                    r = thaw(r)
+                    items.append((keys[i], r))
+                res[i] = r
+
+            if items:
+                self.put_many(items)
+
+        return res
+
+    def reset_stats(self):
+        """Start counting hits and misses anew, e.g., for each task"""
+        self.stats = dict(hits=0, misses=0, evicted=0)
+
+    @property
+    def hit_rate(self):
+        calls = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / calls if calls else 0.0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
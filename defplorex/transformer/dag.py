@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+from __future__ import division
+
+# built-in modules
+import time
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class CycleError(ValueError):
+    pass
+
+
+class TransformerDAG(object):
+    """
+    Dependency graph of transformers, from the fields that they declare to
+    provide (`_provides`) and to require (`_requires`).
+
+    A transformer runs after the providers of the fields it requires, and
+    after the previous providers of the same fields. A transformer that
+    does not declare `_provides` is a barrier: it runs after every
+    transformer listed before it, and before every one listed after it.
+    Independent transformers can run concurrently, up to `threads`.
+
+    Wall times are accumulated per transformer, to find the critical path.
+    """
+    def __init__(self, transformers, threads=1):
+        self.transformers = list(transformers)
+        self.threads = max(1, int(threads))
+
+        self.deps = self._deps(self.transformers)
+        self.order = self._sort(self.deps)
+        self.ancestors = self._ancestors()
+
+        self._lock = threading.Lock()
+        self.timings = [0.0 for _ in self.transformers]
+
+    @staticmethod
+    def _deps(transformers):
+        deps = [set() for _ in transformers]
+        providers = {}
+        barrier = None
+
+        def provides(t):
+            return t._provides if t._provides is not None else ()
+
+        for i, t in enumerate(transformers):
+            for f in provides(t):
+                providers.setdefault(f, []).append(i)
+
+        for i, t in enumerate(transformers):
+            if t._provides is None:
+                # barrier: after everything before it
+                deps[i].update(range(i))
+                barrier = i
+                continue
+
+            if barrier is not None:
+                deps[i].add(barrier)
+
+            for f in t._requires:
+                deps[i].update(j for j in providers.get(f, []) if j != i)
+
+            # the last provider of a field wins, as listed
+            for f in provides(t):
+                deps[i].update(j for j in providers[f] if j < i)
+
+        return deps
+
+    @staticmethod
+    def _sort(deps):
+        order, done = [], set()
+
+        while len(order) < len(deps):
+            ready = [
+                    i for i in range(len(deps))
+                    if i not in done and deps[i] <= done]
+            if not ready:
+                cycle = sorted(set(range(len(deps))) - done)
+                raise CycleError(
+                        'Cyclic dependencies among transformers'
+                        ' {}'.format(cycle))
+            order.extend(ready)
+            done.update(ready)
+
+        return order
+
+    def _ancestors(self):
+        pos = dict((i, n) for n, i in enumerate(self.order))
+        ancestors = [set() for _ in self.order]
+
+        for i in self.order:
+            for j in self.deps[i]:
+                ancestors[i].add(j)
+                ancestors[i].update(ancestors[j])
+
+        return [sorted(a, key=pos.get) for a in ancestors]
+
+    def _timed(self, fn, i):
+        t0 = time.time()
+        try:
+            fn(i)
+        finally:
+            with self._lock:
+                self.timings[i] += time.time() - t0
+
+    def run(self, fn):
+        """Call `fn(i)` on every node `i`, each after its dependencies"""
+        if self.threads == 1:
+            for i in self.order:
+                self._timed(fn, i)
+            return
+
+        cond = threading.Condition()
+        done, running, errors = set(), set(), []
+
+        def worker(i):
+            try:
+                self._timed(fn, i)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with cond:
+                    running.discard(i)
+                    done.add(i)
+                    cond.notify_all()
+
+        with cond:
+            while len(done) < len(self.order) and not errors:
+                ready = [
+                        i for i in self.order
+                        if i not in done and i not in running and
+                        self.deps[i] <= done]
+
+                for i in ready[:self.threads - len(running)]:
+                    running.add(i)
+                    t = threading.Thread(
+                            target=worker,
+                            args=(i,),
+                            name='dpx-dag-{}'.format(i))
+                    t.daemon = True
+                    t.start()
+
+                cond.wait()
+
+            while running:
+                cond.wait()
+
+        if errors:
+            raise errors[0]
+
+    def critical_path(self):
+        """Slowest chain of dependent transformers, and its wall time"""
+        dist, prev = {}, {}
+
+        for i in self.order:
+            best, dist[i] = None, self.timings[i]
+            if self.deps[i]:
+                best = max(self.deps[i], key=dist.get)
+                dist[i] += dist[best]
+            prev[i] = best
+
+        if not dist:
+            return [], 0.0
+
+        i = max(dist, key=dist.get)
+        total = dist[i]
+
+        path = []
+        while i is not None:
+            path.append(self.transformers[i]._name)
+            i = prev[i]
+
+        return path[::-1], total
+
+    def report(self):
+        """Wall time per transformer, and the critical path"""
+        with self._lock:
+            timings = dict(
+                    (t._name, self.timings[i])
+                    for i, t in enumerate(self.transformers))
+        path, total = self.critical_path()
+
+        return dict(timings=timings, critical_path=path, critical_time=total)
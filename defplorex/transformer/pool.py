@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+from __future__ import division
+
+# built-in modules
+import time
+import logging
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+log = logging.getLogger(__name__)
+
+
+def _init_child():
+    from defplorex.worker import registry
+    registry.enter_pool()
+
+
+def _transform_chunk(payload):
+    """Child side: transform one pickled chunk, return pickled results"""
+    from defplorex.worker import registry
+
+    t0 = time.time()
+    transformer, docs, originals, args, kwargs = pickle.loads(payload)
+    kwargs.update(**dict(settings=registry.settings))
+
+    t1 = time.time()
+    res = transformer._transform_each(docs, originals, *args, **kwargs)
+
+    t2 = time.time()
+    res = pickle.dumps(res, pickle.HIGHEST_PROTOCOL)
+
+    timings = dict(
+            unpickle=t1 - t0,
+            compute=t2 - t1,
+            pickle=time.time() - t2)
+
+    return res, timings
+
+
+class TransformerPool(object):
+    """
+    Persistent pool of processes for the CPU-bound transformers of a
+    worker (`_cpu_bound = True`): a page of documents is split in chunks
+    of `chunk_size`, transformed in parallel and collected in order.
+
+    Pickling, IPC and compute times are accumulated in `stats`, so that
+    they can be compared with the time saved.
+    """
+    def __init__(self, processes=None, chunk_size=100):
+        # billiard (unlike multiprocessing) can fork from Celery workers
+        import billiard
+
+        self.chunk_size = max(1, int(chunk_size))
+        self.pool = billiard.Pool(processes=processes, initializer=_init_child)
+
+        self.stats = dict(
+                calls=0, docs=0, bytes_out=0, bytes_in=0,
+                pickle=0.0, unpickle=0.0, compute=0.0, wall=0.0)
+
+        log.info('Transformer process pool ready (%s processes)', processes)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Return a pool if enabled in `settings`, `None` otherwise"""
+        cfg = settings.get('process_pool', {})
+
+        if not cfg.get('enabled', False):
+            return None
+
+        return cls(
+                processes=cfg.get('processes'),
+                chunk_size=cfg.get('chunk_size', 100))
+
+    def transform_batch(self, transformer, docs, originals, *args, **kwargs):
+        from defplorex.transformer.view import thaw
+
+        t0 = time.time()
+
+        # settings are reloaded by the children, views are not picklable
+        kwargs.pop('settings', None)
+        kwargs = thaw(kwargs)
+
+        payloads = []
+        for i in range(0, len(docs), self.chunk_size):
+            payloads.append(pickle.dumps((
+                transformer,
+                [thaw(doc) for doc in docs[i:i + self.chunk_size]],
+                [thaw(doc) for doc in originals[i:i + self.chunk_size]],
+                args,
+                kwargs), pickle.HIGHEST_PROTOCOL))
+
+        t1 = time.time()
+        chunks = self.pool.map(_transform_chunk, payloads)
+        t2 = time.time()
+
+        res = []
+        for payload, _ in chunks:
+            res.extend(pickle.loads(payload))
+
+        t3 = time.time()
+
+        stats = dict(
+                calls=1,
+                docs=len(docs),
+                bytes_out=sum(len(p) for p in payloads),
+                bytes_in=sum(len(p) for p, _ in chunks),
+                pickle=t1 - t0 + sum(t['pickle'] for _, t in chunks),
+                unpickle=t3 - t2 + sum(t['unpickle'] for _, t in chunks),
+                compute=sum(t['compute'] for _, t in chunks),
+                wall=t3 - t0)
+
+        for k, v in stats.items():
+            self.stats[k] += v
+
+        log.info(
+                '%s on %d docs in %d chunks: wall = %.3fs, compute = %.3fs,'
+                ' (un)pickling = %.3fs, IPC = %d/%d bytes out/in',
+                transformer._name, len(docs), len(payloads), stats['wall'],
+                stats['compute'], stats['pickle'] + stats['unpickle'],
+                stats['bytes_out'], stats['bytes_in'])
+
+        return res
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+import logging
+
+from defplorex.quantize import Quantizer, ThresholdStore
+from defplorex.transformer.base import Transformer
+
+log = logging.getLogger(__name__)
+
+
+class QuantizeTransformer(Transformer):
+    """
+    Bin the numeric features of a record (e.g., `n_urls`) into labels
+    (e.g., L/M/H/outlier) by their percentile thresholds, as stored by
+    `dpx features thresholds`. Labels go in the `quantize.field` object.
+
+    Unless pinned with `thresholds_version`, the latest thresholds are
+    used: workers build a new instance once newer ones are computed.
+    """
+    _name = 'quantize'
+    _provides = ('bins',)
+
+    def __init__(self, *args, **kwargs):
+        super(QuantizeTransformer, self).__init__(*args, **kwargs)
+
+        cfg = self.settings.get('quantize', {})
+        self.store = ThresholdStore.from_settings(self.settings)
+        self.pinned = kwargs.get('thresholds_version') is not None
+        thresholds = self.store.load(kwargs.get('thresholds_version'))
+
+        if thresholds is None:
+            raise Exception(
+                    'No thresholds in {}: run `dpx features thresholds`'
+                    ' first'.format(self.store.path))
+
+        self.field = cfg.get('field', 'bins')
+        self.quantizer = Quantizer(
+                thresholds['features'],
+                cfg.get('labels', ['L', 'M', 'H', 'O']))
+
+        # results depend on the thresholds: cache by their version too
+        self.thresholds_version = thresholds['version']
+        self._version = 'q{}'.format(thresholds['version'])
+        self._fields = tuple(sorted(self.quantizer.features))
+        self._provides = (self.field,)
+
+        log.info(
+                'Quantizing %d features by thresholds version %d',
+                len(self._fields), thresholds['version'])
+
+    def outdated(self):
+        """Whether newer thresholds were computed since loading these"""
+        if self.pinned:
+            return False
+
+        versions = self.store.versions()
+        return bool(versions) and versions[-1] != self.thresholds_version
+
+    def __call__(self, doc, *args, **kwargs):
+        return self.transform_batch(
+                [doc], [kwargs.get('original_doc', {})], *args, **kwargs)[0]
+
+    def transform_batch(self, docs, originals, *args, **kwargs):
+        bins = [{} for _ in originals]
+
+        # one vectorized call per feature, over the whole page
+        for f in self._fields:
+            labels = self.quantizer.bin(
+                    f,
+                    [doc.get(f, original_doc.get(f))
+                     for doc, original_doc in zip(docs, originals)])
+
+            for b, label in zip(bins, labels):
+                if label is not None:
+                    b[f] = label
+
+        return [{self.field: b} for b in bins]
@@ -40,6 +40,10 @@ class TagTransformer(Transformer):
     Example transform to append tag to a record.
     """
     _name = 'tag'
+    _version = '2'
+    _fields = ('tags',)
+    _params = ('tag',)
+    _provides = ('tags',)
 
     def __call__(self, doc, *args, **kwargs):
         doc = super(TagTransformer, self).__call__(
@@ -49,15 +53,18 @@ class TagTransformer(Transformer):
 
         if not tag:
             log.debug('No tags supplied, skipping')
-            return []
+            return {}
 
-        tags = doc.get('tags', [])
+        # never modify the original document
+        tags = list(doc.get('tags', []))
 
         if tags:
             log.debug('Found tags: %s', tags)
 
         tags.append(tag)
-        tags = list(set(tags))
+
+        # remove duplicates, keep the order so that re-tagging is a no-op
+        tags = [t for i, t in enumerate(tags) if t not in tags[:i]]
 
         log.debug('Updated tags: %s', tags)
 
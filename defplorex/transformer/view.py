@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
+
+class ReadOnlyList(Sequence):
+    """Read-only proxy of a list: no copy, and no way to modify it"""
+    __slots__ = ('_data',)
+    __hash__ = None
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ReadOnlyList(self._data[i])
+        return frozen(self._data[i])
+
+    def __iter__(self):
+        for v in self._data:
+            yield frozen(v)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        return self._data == thaw(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return list(self._data) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+    def copy(self):
+        return list(self._data)
+
+
+class ReadOnlyDict(Mapping):
+    """Read-only proxy of a dict: no copy, and no way to modify it"""
+    __slots__ = ('_data',)
+    __hash__ = None
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, k):
+        return frozen(self._data[k])
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, k):
+        return k in self._data
+
+    def __eq__(self, other):
+        return self._data == thaw(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._data)
+
+    def copy(self):
+        return dict(self._data)
+
+
+def frozen(v):
+    """Read-only proxy of `v` if it is mutable, `v` itself otherwise"""
+    if isinstance(v, list):
+        return ReadOnlyList(v)
+    if isinstance(v, dict):
+        return ReadOnlyDict(v)
+    return v
+
+
+def thaw(v):
+    """Replace the read-only proxies in `v` with the objects they wrap"""
+    if isinstance(v, (ReadOnlyList, ReadOnlyDict)):
+        return v._data
+    if isinstance(v, DocView):
+        return v.merged()
+    if isinstance(v, list):
+        return [thaw(x) for x in v]
+    if isinstance(v, dict):
+        return dict((k, thaw(x)) for k, x in v.items())
+    return v
+
+
+class DocView(Mapping):
+    """
+    Read-only, copy-free view of a document through a stack of layers
+    (e.g., the updates of each transformer over the original document):
+    the topmost layer holding a field wins. Nested lists and dicts are
+    returned as read-only proxies, so the layers cannot be modified.
+    """
+    __slots__ = ('_layers',)
+
+    def __init__(self, *layers):
+        self._layers = layers
+
+    def __getitem__(self, k):
+        for layer in reversed(self._layers):
+            if k in layer:
+                return frozen(layer[k])
+        raise KeyError(k)
+
+    def __contains__(self, k):
+        return any(k in layer for layer in self._layers)
+
+    def __iter__(self):
+        seen = set()
+        for layer in reversed(self._layers):
+            for k in layer:
+                if k not in seen:
+                    seen.add(k)
+                    yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'DocView({!r})'.format(self.merged())
+
+    def copy(self):
+        return self.merged()
+
+    def merged(self):
+        """Flatten the layers into one (new) dict"""
+        res = {}
+        for layer in self._layers:
+            res.update(layer)
+        return res
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Trend Micro Incorporated
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of the FreeBSD Project.
+
+
+import os
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class WorkerRegistry(object):
+    """
+    Per-process holder of the objects that tasks can share: settings, ES
+    client (and its connection pool), transformer instances and the
+    resources that drive them (cache, event loop, process pool, feature
+    sketches).
+
+    Objects are created lazily, or eagerly by `setup()` when the worker
+    process starts, and live until `teardown()`.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._settings = None
+        self._es = None
+        self._cache = None
+        self._loop = None
+        self._pool = None
+        self._sketches = None
+        self._in_pool = False
+        self._transformers = {}
+
+    def _check_pid(self):
+        # never share sockets with a parent we have been forked from
+        if self._pid != os.getpid():
+            log.debug('Fork detected, dropping inherited registry')
+            settings = self._settings
+            self._reset()
+
+            # plain data: safe to inherit
+            self._settings = settings
+
+    @property
+    def settings(self):
+        with self._lock:
+            self._check_pid()
+            if self._settings is None:
+                from defplorex.config import load_settings
+                self._settings = load_settings()
+            return self._settings
+
+    @property
+    def es(self):
+        with self._lock:
+            self._check_pid()
+            if self._es is None:
+                from defplorex.backend.elastic import ES
+                self._es = ES(self.settings)
+            return self._es
+
+    @property
+    def cache(self):
+        """Transformer result cache, or `None` if disabled in settings"""
+        with self._lock:
+            self._check_pid()
+            if self._cache is None:
+                from defplorex.transformer.cache import TransformerCache
+                self._cache = TransformerCache.from_settings(self.settings)
+                if self._cache is None:
+                    self._cache = False
+            return self._cache or None
+
+    @property
+    def event_loop(self):
+        """Event loop thread that drives the `AsyncTransformer`s"""
+        with self._lock:
+            self._check_pid()
+            if self._loop is None:
+                from defplorex.transformer.aio import EventLoopThread
+                self._loop = EventLoopThread(
+                        self.settings.get('async', {}).get('concurrency', 100))
+            return self._loop
+
+    @property
+    def process_pool(self):
+        """
+        Process pool for CPU-bound transformers, or `None` if disabled in
+        settings or if this process belongs to the pool itself
+        """
+        with self._lock:
+            self._check_pid()
+            if self._in_pool:
+                return None
+            if self._pool is None:
+                from defplorex.transformer.pool import TransformerPool
+                self._pool = TransformerPool.from_settings(self.settings)
+                if self._pool is None:
+                    self._pool = False
+            return self._pool or None
+
+    @property
+    def sketches(self):
+        """Feature sketches of this process, or `None` if disabled"""
+        with self._lock:
+            self._check_pid()
+            if self._sketches is None:
+                from defplorex.sketch import FeatureSketches
+                self._sketches = FeatureSketches.from_settings(self.settings)
+                if self._sketches is None:
+                    self._sketches = False
+            return self._sketches or None
+
+    def enter_pool(self):
+        """Mark this process as a member of a `TransformerPool`"""
+        with self._lock:
+            self._check_pid()
+            self._in_pool = True
+
+    def transformer(self, cls, tr_args=(), tr_kwargs=None):
+        """Return a (cached) instance of `cls` built with these arguments"""
+        tr_kwargs = dict(tr_kwargs or {})
+        key = (
+                cls._name,
+                repr(tuple(tr_args)),
+                repr(sorted(tr_kwargs.items())))
+
+        with self._lock:
+            self._check_pid()
+            if key in self._transformers and \
+                    self._transformers[key].outdated():
+                log.info('Reloading outdated transformer %s', cls._name)
+                del self._transformers[key]
+            if key not in self._transformers:
+                log.debug('Creating transformer %s', cls._name)
+                tr_kwargs.update(**dict(settings=self.settings))
+                self._transformers[key] = cls(*tr_args, **tr_kwargs)
+            return self._transformers[key]
+
+    def setup(self, transformer_classes=()):
+        """Create settings, ES client and default transformers upfront"""
+        self.es
+        self.cache
+        for cls in transformer_classes:
+            try:
+                self.transformer(cls)
+            except Exception as e:
+                log.debug('Cannot warm up transformer %s: %s', cls._name, e)
+
+        log.info('Worker registry ready (pid = %d)', self._pid)
+
+    def teardown(self):
+        """Close the ES connections and drop every cached object"""
+        with self._lock:
+            if self._es is not None and self._pid == os.getpid():
+                try:
+                    self._es.client.transport.close()
+                except Exception as e:
+                    log.warn('Cannot close ES connections: %s', e)
+            if self._cache and self._pid == os.getpid():
+                self._cache.close()
+            if self._loop is not None and self._pid == os.getpid():
+                self._loop.close()
+            if self._pool and self._pid == os.getpid():
+                self._pool.close()
+            if self._sketches and self._pid == os.getpid():
+                self._sketches.flush(force=True)
+            self._reset()
+
+        log.info('Worker registry closed (pid = %d)', self._pid)
+
+
+registry = WorkerRegistry()